@@ -21,6 +21,10 @@ Host dev
   IdentityFile ~/.ssh/id_rsa
   IdentitiesOnly yes
   StrictHostKeyChecking accept-new
+  # Later ssh calls reuse an open session's connection. No ControlPersist: a lingering
+  # master would keep the LocalForward ports bound after the session ends.
+  ControlMaster auto
+  ControlPath ~/.ssh/cm-%C
   # IaC system range: server listens on 57800, 57801, 57802 (OpenObserve, Traefik, Prefect)
   LocalForward 57800 localhost:57800
   LocalForward 57801 localhost:57801
@@ -32,6 +36,10 @@ Host prod
   IdentityFile ~/.ssh/id_rsa
   IdentitiesOnly yes
   StrictHostKeyChecking accept-new
+  # Later ssh calls reuse an open session's connection. No ControlPersist: a lingering
+  # master would keep the LocalForward ports bound after the session ends.
+  ControlMaster auto
+  ControlPath ~/.ssh/cm-%C
   # IaC system range: server listens on 57800, 57801, 57802
   LocalForward 57800 localhost:57800
   LocalForward 57801 localhost:57801
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Deploy history of one app: <dir>/deploy-history.jsonl, one JSON object per deployment
+(oldest first, append-only), same shape as the old YAML entries:
+
+  {"image": {"tag", "digest", "description", "built_at"}, "deployment": {"deployed_at", "workspace"}}
+
+Readers scan from the end for the latest entry per workspace; compaction keeps the file
+short by moving older lines to deploy-history.archive.jsonl.gz (gzip members appended),
+never the latest entry of a workspace.
+
+  deploy_history.py append <dir> <entry-json>   # migrates deploy-history.yml first, if present
+  deploy_history.py compact <dir> <keep>
+
+Migration is lossless: YAML scalars are kept as the strings written (BaseLoader, so a tag
+like 1234567 stays "1234567"), and the YAML file is kept as deploy-history.yml.migrated.
+A YAML file that does not parse is kept as deploy-history.yml.unparsed (with a warning)
+and the deploy goes on.
+Runs on the server (ansible.builtin.script) as the iac user; stdlib + PyYAML only.
+"""
+
+import gzip
+import json
+import os
+import sys
+from pathlib import Path
+
+HISTORY = "deploy-history.jsonl"
+LEGACY = "deploy-history.yml"
+ARCHIVE = "deploy-history.archive.jsonl.gz"
+
+
+def _line(entry: dict) -> str:
+    return json.dumps(entry, separators=(",", ":")) + "\n"
+
+
+def migrate(app_dir: Path) -> int:
+    """Convert deploy-history.yml to JSON lines (before any existing lines). Returns entries migrated.
+
+    A legacy file that cannot be parsed is renamed to deploy-history.yml.unparsed with a
+    warning, never raised: a bad old history must not block deploys.
+    """
+    legacy = app_dir / LEGACY
+    if not legacy.is_file():
+        return 0
+    try:
+        import yaml
+    except ImportError:
+        print(f"warning: PyYAML missing, {legacy} not migrated", file=sys.stderr)
+        return 0
+
+    try:
+        entries = yaml.load(legacy.read_text(), Loader=yaml.BaseLoader) or []
+        if not isinstance(entries, list):
+            raise ValueError("expected a list of entries")
+    except (yaml.YAMLError, ValueError) as e:
+        unparsed = legacy.with_name(LEGACY + ".unparsed")
+        legacy.rename(unparsed)
+        print(f"warning: {legacy} not migrated ({e}); kept as {unparsed.name}", file=sys.stderr)
+        return 0
+    history = app_dir / HISTORY
+    existing = history.read_text() if history.is_file() else ""
+    tmp = history.with_suffix(".jsonl.tmp")
+    tmp.write_text("".join(_line(e) for e in entries) + existing)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, history)
+    legacy.rename(legacy.with_name(LEGACY + ".migrated"))
+    return len(entries)
+
+
+def append(app_dir: Path, entry_json: str) -> None:
+    entry = json.loads(entry_json)
+    migrated = migrate(app_dir)
+    if migrated:
+        print(f"migrated {migrated} entr{'y' if migrated == 1 else 'ies'} from {LEGACY}")
+    history = app_dir / HISTORY
+    with history.open("a") as f:
+        f.write(_line(entry))
+    os.chmod(history, 0o644)
+
+
+def _workspace(line: str) -> str:
+    try:
+        return str((json.loads(line).get("deployment") or {}).get("workspace") or "")
+    except (json.JSONDecodeError, AttributeError):
+        return ""
+
+
+def compact(app_dir: Path, keep: int) -> None:
+    """Archive all but the newest `keep` entries; the latest entry per workspace always stays."""
+    history = app_dir / HISTORY
+    if not history.is_file():
+        return
+    lines = history.read_text().splitlines(keepends=True)
+    retain = set(range(max(0, len(lines) - keep), len(lines)))
+    latest: dict[str, int] = {}
+    for i, line in enumerate(lines):
+        latest[_workspace(line)] = i
+    retain.update(latest.values())
+    old = [line for i, line in enumerate(lines) if i not in retain]
+    if not old:
+        return
+    with gzip.open(app_dir / ARCHIVE, "at") as f:
+        f.writelines(old)
+    os.chmod(app_dir / ARCHIVE, 0o644)
+    tmp = history.with_suffix(".jsonl.tmp")
+    tmp.write_text("".join(line for i, line in enumerate(lines) if i in retain))
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, history)
+    print(f"archived {len(old)} entr{'y' if len(old) == 1 else 'ies'} to {ARCHIVE}")
+
+
+def main() -> None:
+    if len(sys.argv) != 4 or sys.argv[1] not in ("append", "compact"):
+        raise SystemExit(__doc__)
+    command, app_dir = sys.argv[1], Path(sys.argv[2])
+    if command == "append":
+        append(app_dir, sys.argv[3])
+    else:
+        compact(app_dir, int(sys.argv[3]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,77 @@
-"""Postgres dumps from backup.yml (-F c). CLI: python -m prefect.backup.capture_postgres <deploy_dir> [--output-dir <dir>]"""
+"""Postgres dumps from backup.yml (-F c). CLI: python -m prefect.backup.capture_postgres <deploy_dir> [--output-dir <dir>]
 
+Entries with `mode: stream` are not dumped to files here: postgres_streams() returns their
+pg_dump commands, which the backup flow pipes straight into restic (no staging copy).
+
+Per entry `format`: custom (default, one postgres_<service>.dump) or directory (-F d, one
+file per table, dumped by `jobs` parallel workers). Staged directory dumps are copied out
+as postgres_<service>.dir/ (restic dedups unchanged table files); streamed ones are a tar,
+postgres_<service>.dir.tar. `compress` is passed to pg_dump -Z (e.g. 6, zstd:3 on PG16+).
+
+`mode: basebackup` takes a physical pg_basebackup instead (postgres_<service>.base/ plus
+postgres_<service>.base.json). With a previous manifest in state_dir the backup is a PG17
+incremental (--incremental; needs summarize_wal = on), so nightly size follows the change
+volume; every `full_every` backups (default 7) a new chain starts with a full backup. The
+flow tags the snapshot pgchain:<service>:<chain> and calls commit_basebackups() once restic
+has stored it; restore combines the chain with pg_combinebackup.
+"""
+
+import json
+import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
+from datetime import datetime, timezone
 from pathlib import Path
 
 import yaml
 from dotenv import dotenv_values
 
+FORMATS = ("custom", "directory")
+BASEBACKUP_DIR = "/tmp/prefect_basebackup"
+PREV_MANIFEST = "/tmp/prefect_basebackup.manifest"
 
-def capture_postgres(deploy_dir: Path, out_dir: Path | None = None) -> list[Path]:
-    """Run pg_dump per backup.yml postgres entry into out_dir; returns dump paths or []."""
-    deploy_dir = deploy_dir.resolve()
+
+def dump_name(service: str, entry: dict | None = None, stream: bool = False) -> str:
+    """Name of a service's dump (staging file/dir or restic stdin filename); keep in sync with restore."""
+    if _format(entry or {}) == "directory":
+        return f"postgres_{service}.dir.tar" if stream else f"postgres_{service}.dir"
+    return f"postgres_{service}.dump"
+
+
+def _format(entry: dict) -> str:
+    fmt = entry.get("format") or "custom"
+    if fmt not in FORMATS:
+        raise ValueError(f"postgres entry service={entry.get('service')}: unknown format {fmt!r} (use {', '.join(FORMATS)})")
+    return fmt
+
+
+def _dump_options(entry: dict) -> str:
+    """pg_dump format / parallelism / compression options for an entry (shell words)."""
+    if _format(entry) == "directory":
+        options = ["-F", "d", "-j", str(max(1, int(entry.get("jobs") or 1)))]
+    else:
+        options = ["-F", "c"]
+    if entry.get("compress") is not None:
+        options += ["-Z", str(entry["compress"])]
+    return " ".join(shlex.quote(o) for o in options)
+
+
+def _load_config(deploy_dir: Path, config: dict | None) -> dict:
+    if config is not None:
+        return config
     backup_yml = deploy_dir / "backup.yml"
     if not backup_yml.exists():
-        return []
-    config = yaml.safe_load(backup_yml.read_text()) or {}
+        return {}
+    return yaml.safe_load(backup_yml.read_text()) or {}
+
+
+def _postgres_entries(deploy_dir: Path, config: dict) -> list[tuple[dict, str, str]]:
+    """(entry, user, db) for each complete postgres entry; user/db resolved from deploy .env."""
     postgres_list = config.get("postgres") or []
     if not postgres_list:
         return []
-
-    if out_dir is None:
-        out_dir = Path(tempfile.mkdtemp(prefix="backup-capture-"))
-    out_dir = out_dir.resolve()
-    out_dir.mkdir(parents=True, exist_ok=True)
-
     env_path = deploy_dir / ".env"
     env = dict(dotenv_values(env_path)) if env_path.exists() else {}
     result = []
@@ -40,14 +87,236 @@ def capture_postgres(deploy_dir: Path, out_dir: Path | None = None) -> list[Path
             raise ValueError(
                 f"postgres entry service={service}: missing in .env (need {user_key}=..., {db_key}=...)"
             )
-        dump_path = out_dir / f"postgres_{service}.dump"
+        result.append((entry, user, db))
+    return result
+
+
+def postgres_streams(deploy_dir: Path, config: dict | None = None) -> list[tuple[str, list[str]]]:
+    """(dump name, command) per `mode: stream` entry; the command writes the dump to stdout.
+
+    Custom format goes straight to stdout; a directory dump needs a temporary directory in
+    the container, which is tarred to stdout and removed.
+    """
+    deploy_dir = deploy_dir.resolve()
+    result = []
+    for entry, user, db in _postgres_entries(deploy_dir, _load_config(deploy_dir, config)):
+        if entry.get("mode") != "stream":
+            continue
+        service = entry["service"]
+        if _format(entry) == "directory":
+            dump_dir = "/tmp/prefect_pgdump.dir"
+            script = (
+                f'rm -rf {dump_dir} && pg_dump -U "$1" -d "$2" {_dump_options(entry)} -f {dump_dir}'
+                f" && tar cf - -C {dump_dir} .; rc=$?; rm -rf {dump_dir}; exit $rc"
+            )
+        else:
+            script = f'pg_dump -U "$1" -d "$2" {_dump_options(entry)}'
+        cmd = [
+            "docker", "compose",
+            "--project-directory", str(deploy_dir),
+            "exec", "-T", service,
+            "sh", "-c", script,
+            "_", user, db,
+        ]
+        result.append((dump_name(service, entry, stream=True), cmd))
+    return result
+
+
+def _capture_directory(deploy_dir: Path, service: str, user: str, db: str, entry: dict, out_dir: Path) -> Path:
+    """pg_dump -F d -j N inside the container, then `docker compose cp` the directory to out_dir."""
+    compose = ["docker", "compose", "--project-directory", str(deploy_dir)]
+    dump_dir = "/tmp/prefect_pgdump.dir"
+    dump_path = out_dir / dump_name(service, entry)
+    script = f'rm -rf {dump_dir} && pg_dump -U "$1" -d "$2" {_dump_options(entry)} -f {dump_dir}'
+    try:
+        r = subprocess.run(
+            compose + ["exec", "-T", service, "sh", "-c", script, "_", user, db],
+            cwd=deploy_dir, capture_output=True, text=True,
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"pg_dump failed for {service}: {r.stderr or ''}")
+        r = subprocess.run(
+            compose + ["cp", f"{service}:{dump_dir}", str(dump_path)],
+            cwd=deploy_dir, capture_output=True, text=True,
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"copying dump directory of {service} failed: {r.stderr or ''}")
+    finally:
+        subprocess.run(
+            compose + ["exec", "-T", service, "rm", "-rf", dump_dir],
+            cwd=deploy_dir, capture_output=True, check=False,
+        )
+    if not (dump_path / "toc.dat").is_file():
+        raise RuntimeError(f"pg_dump for {service} produced no toc.dat in {dump_path}")
+    return dump_path
+
+
+# Cluster WAL insert position + this DB's row change counters: unchanged means no writes
+# since the last backup (reading them commits nothing, unlike xact_commit).
+_FINGERPRINT_SQL = (
+    "SELECT pg_current_wal_lsn(), tup_inserted, tup_updated, tup_deleted"
+    " FROM pg_stat_database WHERE datname = current_database()"
+)
+# pg_basebackup's checkpoint and backup-end record move the WAL position on every run,
+# so basebackup entries are fingerprinted by the row change counters only.
+_COUNTERS_SQL = (
+    "SELECT tup_inserted, tup_updated, tup_deleted"
+    " FROM pg_stat_database WHERE datname = current_database()"
+)
+
+
+def postgres_fingerprints(deploy_dir: Path, config: dict | None = None) -> dict[str, str | None]:
+    """{"postgres:<service>": fingerprint} per entry; None when it cannot be read (capture anyway).
+
+    Conservative: WAL written by other databases of the cluster or a stats reset also counts
+    as a change. `mode: basebackup` entries leave out the WAL position (see _COUNTERS_SQL).
+    """
+    deploy_dir = deploy_dir.resolve()
+    result: dict[str, str | None] = {}
+    for entry, user, db in _postgres_entries(deploy_dir, _load_config(deploy_dir, config)):
+        service = entry["service"]
+        sql = _COUNTERS_SQL if entry.get("mode") == "basebackup" else _FINGERPRINT_SQL
+        r = subprocess.run(
+            [
+                "docker", "compose",
+                "--project-directory", str(deploy_dir),
+                "exec", "-T", service,
+                "sh", "-c", 'psql -U "$1" -d "$2" -XAt -c "$3"',
+                "_", user, db, sql,
+            ],
+            cwd=deploy_dir, capture_output=True, text=True,
+        )
+        result[f"postgres:{service}"] = r.stdout.strip() if r.returncode == 0 and r.stdout.strip() else None
+    return result
+
+
+def basebackup_name(service: str) -> str:
+    """Staged base backup dir of a service (metadata: same name + .json); keep in sync with restore."""
+    return f"postgres_{service}.base"
+
+
+def _run_basebackup(deploy_dir: Path, service: str, user: str, dest: Path, manifest: Path | None) -> None:
+    """pg_basebackup (plain format, WAL streamed) in the container, copied out to dest."""
+    compose = ["docker", "compose", "--project-directory", str(deploy_dir)]
+    script = f'rm -rf {BASEBACKUP_DIR} && pg_basebackup -U "$1" -D {BASEBACKUP_DIR} -F p -X stream -c fast --no-password'
+    if dest.exists():
+        shutil.rmtree(dest)
+    try:
+        if manifest is not None:
+            script += f" --incremental={PREV_MANIFEST}"
+            r = subprocess.run(
+                compose + ["cp", str(manifest), f"{service}:{PREV_MANIFEST}"],
+                cwd=deploy_dir, capture_output=True, text=True,
+            )
+            if r.returncode != 0:
+                raise RuntimeError(f"copying previous manifest to {service} failed: {r.stderr or ''}")
+        r = subprocess.run(
+            compose + ["exec", "-T", service, "sh", "-c", script, "_", user],
+            cwd=deploy_dir, capture_output=True, text=True,
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"pg_basebackup failed for {service}: {r.stderr or ''}")
+        r = subprocess.run(
+            compose + ["cp", f"{service}:{BASEBACKUP_DIR}", str(dest)],
+            cwd=deploy_dir, capture_output=True, text=True,
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"copying base backup of {service} failed: {r.stderr or ''}")
+    finally:
+        subprocess.run(
+            compose + ["exec", "-T", service, "rm", "-rf", BASEBACKUP_DIR, PREV_MANIFEST],
+            cwd=deploy_dir, capture_output=True, check=False,
+        )
+    if not (dest / "backup_manifest").is_file():
+        raise RuntimeError(f"pg_basebackup for {service} produced no backup_manifest in {dest}")
+
+
+def _capture_basebackup(
+    deploy_dir: Path, service: str, user: str, entry: dict, out_dir: Path, state_dir: Path | None
+) -> Path:
+    """Full or incremental base backup into out_dir; writes the chain position next to it."""
+    name = basebackup_name(service)
+    full_every = max(1, int(entry.get("full_every") or 7))
+    previous: dict = {}
+    manifest = state_dir / f"{name}.manifest" if state_dir else None
+    if state_dir and (state_dir / f"{name}.json").is_file() and manifest.is_file():
+        previous = json.loads((state_dir / f"{name}.json").read_text())
+    dest = out_dir / name
+    position = None
+    if previous and previous.get("seq", 0) + 1 < full_every:
+        try:
+            _run_basebackup(deploy_dir, service, user, dest, manifest)
+            position = {"chain": previous["chain"], "seq": previous["seq"] + 1}
+        except RuntimeError as e:
+            print(f"{service}: incremental base backup failed, taking a full one: {e}", file=sys.stderr)
+    if position is None:
+        _run_basebackup(deploy_dir, service, user, dest, None)
+        position = {"chain": datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"), "seq": 0}
+    (out_dir / f"{name}.json").write_text(json.dumps({"service": service, **position}))
+    return dest
+
+
+def basebackup_tags(staging: Path) -> list[str]:
+    """pgchain:<service>:<chain> restic tags for the base backups staged in staging."""
+    tags = []
+    for meta_path in sorted(staging.glob("postgres_*.base.json")):
+        meta = json.loads(meta_path.read_text())
+        tags.append(f"pgchain:{meta['service']}:{meta['chain']}")
+    return tags
+
+
+def commit_basebackups(staging: Path, state_dir: Path) -> None:
+    """After restic stored staging: keep each base backup's manifest as the next incremental's parent."""
+    for meta_path in staging.glob("postgres_*.base.json"):
+        name = meta_path.name.removesuffix(".json")
+        state_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(staging / name / "backup_manifest", state_dir / f"{name}.manifest")
+        shutil.copyfile(meta_path, state_dir / meta_path.name)
+
+
+def capture_postgres(
+    deploy_dir: Path,
+    out_dir: Path | None = None,
+    config: dict | None = None,
+    state_dir: Path | None = None,
+) -> list[Path]:
+    """Run pg_dump per backup.yml postgres entry into out_dir; returns dump paths or [].
+
+    config: parsed backup.yml (e.g. from the deploy state index); read from deploy_dir if None.
+    `mode: stream` entries are skipped (see postgres_streams). `mode: basebackup` entries
+    continue the incremental chain recorded in state_dir (None: always a full backup).
+    """
+    deploy_dir = deploy_dir.resolve()
+    entries = [
+        (entry, user, db)
+        for entry, user, db in _postgres_entries(deploy_dir, _load_config(deploy_dir, config))
+        if entry.get("mode") != "stream"
+    ]
+    if not entries:
+        return []
+
+    if out_dir is None:
+        out_dir = Path(tempfile.mkdtemp(prefix="backup-capture-"))
+    out_dir = out_dir.resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    result = []
+    for entry, user, db in entries:
+        service = entry["service"]
+        if entry.get("mode") == "basebackup":
+            result.append(_capture_basebackup(deploy_dir, service, user, entry, out_dir, state_dir))
+            continue
+        if _format(entry) == "directory":
+            result.append(_capture_directory(deploy_dir, service, user, db, entry, out_dir))
+            continue
+        dump_path = out_dir / dump_name(service)
         dump_in_container = "/tmp/prefect_pgdump.dump"
         cmd = [
             "docker", "compose",
             "--project-directory", str(deploy_dir),
             "exec", "-T", service,
             "sh", "-c",
-            "pg_dump -U \"$1\" -d \"$2\" -F c -f " + dump_in_container + " && cat " + dump_in_container,
+            f"pg_dump -U \"$1\" -d \"$2\" {_dump_options(entry)} -f " + dump_in_container + " && cat " + dump_in_container,
             "_", user, db,
         ]
         with open(dump_path, "wb") as f:
@@ -1,27 +1,176 @@
-"""Volume tar capture from backup.yml. CLI: python -m prefect.backup.capture_volumes <deploy_dir> [--output-dir <dir>]"""
+"""Volume tar capture from backup.yml. CLI: python -m prefect.backup.capture_volumes <deploy_dir> [--output-dir <dir>]
 
+Per volume entry `mode`:
+  tar     (default) tar into out_dir via one `docker compose run` per service (capture_volumes)
+  stream  tar to stdout from a throwaway container with the service's volumes mounted
+          read-only; the backup flow pipes it into restic (volume_streams, no staging file)
+  native  restic reads the Docker volume's host directory in place, so unchanged files are
+          skipped by its change detection (volume_paths; worker mounts VOLUMES_ROOT read-only)
+"""
+
+import hashlib
+import json
+import os
 import shlex
 import subprocess
 import sys
 import tempfile
+import time
 from pathlib import Path
 
 import yaml
 
+VOLUME_MODES = ("tar", "stream", "native")
+# Docker's volume store on the host; mounted read-only at the same path in the worker.
+VOLUMES_ROOT = Path("/var/lib/docker/volumes")
+# stderr markers of the capture script, timestamped as they arrive for per-volume timings.
+_START_MARK = "@@iac-volume-start@@"
+_DONE_MARK = "@@iac-volume-done@@"
+
 
 def _volume_slug(path: str) -> str:
     """Tar name segment; keep in sync with restore_from_backup._path_slug."""
     return path.strip("/").replace("/", "_") or "root"
 
 
-def capture_volumes(deploy_dir: Path, out_dir: Path | None = None) -> list[Path]:
-    """Read backup.yml from deploy dir, tar each volume into out_dir. Returns list of tarball paths."""
-    deploy_dir = deploy_dir.resolve()
+def _load_config(deploy_dir: Path, config: dict | None) -> dict:
+    if config is not None:
+        return config
     backup_yml = deploy_dir / "backup.yml"
     if not backup_yml.exists():
-        return []
-    config = yaml.safe_load(backup_yml.read_text()) or {}
-    volumes = config.get("volumes") or []
+        return {}
+    return yaml.safe_load(backup_yml.read_text()) or {}
+
+
+def _volume_entries(config: dict, mode: str) -> list[tuple[str, str]]:
+    """(service, path) of complete volume entries with the given mode."""
+    result = []
+    for v in config.get("volumes") or []:
+        service, path = v.get("service"), v.get("path")
+        if not service or not path:
+            continue
+        entry_mode = v.get("mode") or "tar"
+        if entry_mode not in VOLUME_MODES:
+            raise ValueError(f"volume {service}:{path}: unknown mode {entry_mode!r} (use {', '.join(VOLUME_MODES)})")
+        if entry_mode == mode:
+            result.append((service, path))
+    return result
+
+
+def tar_name(service: str, path: str) -> str:
+    """File name of a volume tar (staging file or restic stdin filename)."""
+    return f"{service}_{_volume_slug(path)}.tar"
+
+
+def service_container(deploy_dir: Path, service: str) -> str:
+    """ID of the service's container (running or stopped)."""
+    r = subprocess.run(
+        ["docker", "compose", "--project-directory", str(deploy_dir), "ps", "-a", "-q", service],
+        cwd=deploy_dir, capture_output=True, text=True,
+    )
+    container = r.stdout.strip().splitlines()[0] if r.stdout.strip() else ""
+    if r.returncode != 0 or not container:
+        raise RuntimeError(f"no container for service {service}: {r.stderr or 'not created'}")
+    return container
+
+
+def volume_source(deploy_dir: Path, service: str, path: str) -> Path:
+    """Host directory holding `path` of the service: its named volume's _data plus the rest of path."""
+    container = service_container(deploy_dir, service)
+    r = subprocess.run(["docker", "inspect", container], capture_output=True, text=True)
+    if r.returncode != 0:
+        raise RuntimeError(f"docker inspect {container} failed: {r.stderr}")
+    mounts = (json.loads(r.stdout) or [{}])[0].get("Mounts") or []
+    path = "/" + path.strip("/")
+    best = None
+    for m in mounts:
+        dest = "/" + (m.get("Destination") or "").strip("/")
+        if m.get("Type") == "volume" and (path == dest or path.startswith(dest.rstrip("/") + "/")):
+            if best is None or len(dest) > len(best[0]):
+                best = (dest, m.get("Source") or "")
+    if best is None or not best[1]:
+        raise RuntimeError(f"{service}:{path} is not on a Docker volume (native mode needs a named volume)")
+    return Path(best[1]) / path[len(best[0]):].lstrip("/")
+
+
+def _capture_script(volumes: list[tuple[str, str]]) -> str:
+    """sh script tarring each (tar name, path) into /backup-out, with start/done markers on stderr."""
+    steps = ["set -e"]
+    for name, path in volumes:
+        name_q = shlex.quote(name)
+        steps.append(
+            f"echo {_START_MARK} {name_q} >&2; "
+            f"tar cf /backup-out/{name_q} -C {shlex.quote(path)} .; "
+            f"echo {_DONE_MARK} {name_q} >&2"
+        )
+    return "\n".join(steps)
+
+
+def _run_capture(cmd: list[str], deploy_dir: Path, timings: dict[str, float]) -> None:
+    """Run one capture container; record seconds per tar name from the stderr markers."""
+    proc = subprocess.Popen(cmd, cwd=deploy_dir, stderr=subprocess.PIPE, text=True)
+    errors: list[str] = []
+    current: tuple[str, float] | None = None
+    for line in proc.stderr:
+        mark, _, name = line.strip().partition(" ")
+        if mark == _START_MARK:
+            current = (name, time.monotonic())
+        elif mark == _DONE_MARK and current and current[0] == name:
+            timings[name] = time.monotonic() - current[1]
+            current = None
+        else:
+            errors.append(line)
+    if proc.wait() != 0:
+        failed = f" (while writing {current[0]})" if current else ""
+        raise RuntimeError(("".join(errors) or "docker compose run failed") + failed)
+
+
+def _tree_fingerprint(root: Path) -> str:
+    """sha256 over (relative path, inode, size, mtime, mode) of every entry below root."""
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            rel = os.path.relpath(path, root)
+            digest.update(f"{rel}\0{st.st_ino}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_mode}\n".encode())
+    return digest.hexdigest()
+
+
+def volume_fingerprints(deploy_dir: Path, config: dict | None = None) -> dict[str, str | None]:
+    """{"volume:<service>:<path>": fingerprint} for every entry (any mode), read from the host
+    volume dir under VOLUMES_ROOT (metadata only); None when it is not readable (capture anyway).
+    """
+    deploy_dir = deploy_dir.resolve()
+    config = _load_config(deploy_dir, config)
+    result: dict[str, str | None] = {}
+    for mode in VOLUME_MODES:
+        for service, path in _volume_entries(config, mode):
+            key = f"volume:{service}:{path}"
+            try:
+                source = volume_source(deploy_dir, service, path)
+                result[key] = _tree_fingerprint(source) if source.is_dir() else None
+            except (RuntimeError, OSError):
+                result[key] = None
+    return result
+
+
+def capture_volumes(
+    deploy_dir: Path,
+    out_dir: Path | None = None,
+    config: dict | None = None,
+    timings: dict[str, float] | None = None,
+) -> list[Path]:
+    """Read backup.yml from deploy dir, tar each volume into out_dir. Returns list of tarball paths.
+
+    config: parsed backup.yml (e.g. from the deploy state index); read from deploy_dir if None.
+    Only `mode: tar` entries (the default); see volume_streams / volume_paths for the others.
+    All volumes of a service are written by one `docker compose run` container; timings,
+    if given, receives {tar name: seconds} per volume.
+    """
+    deploy_dir = deploy_dir.resolve()
+    volumes = _volume_entries(_load_config(deploy_dir, config), "tar")
     if not volumes:
         return []
 
@@ -29,28 +178,58 @@ def capture_volumes(deploy_dir: Path, out_dir: Path | None = None) -> list[Path]
     out_dir = out_dir.resolve()
     out_dir.mkdir(parents=True, exist_ok=True)
 
+    by_service: dict[str, list[tuple[str, str]]] = {}
+    for service, path in volumes:
+        by_service.setdefault(service, []).append((tar_name(service, path), path))
+
     # Bind-mount out_dir: compose run stdout must not be piped to a file (stream corruption).
-    result = []
-    for v in volumes:
-        service, path = v.get("service"), v.get("path")
-        if not service or not path:
-            continue
-        tar_name = f"{service}_{_volume_slug(path)}.tar"
-        tar_path = out_dir / tar_name
-        out_in_container = shlex.quote(f"/backup-out/{tar_name}")
-        path_q = shlex.quote(path)
+    timings = {} if timings is None else timings
+    for service, service_volumes in by_service.items():
         cmd = [
             "docker", "compose",
             "--project-directory", str(deploy_dir),
             "run", "--rm", "-T",
             "-v", f"{out_dir}:/backup-out:rw",
             service,
-            "sh", "-c", f"tar cf {out_in_container} -C {path_q} .",
+            "sh", "-c", _capture_script(service_volumes),
         ]
-        r = subprocess.run(cmd, cwd=deploy_dir, stderr=subprocess.PIPE, text=True)
+        _run_capture(cmd, deploy_dir, timings)
+    return [out_dir / tar_name(service, path) for service, path in volumes]
+
+
+def volume_streams(deploy_dir: Path, config: dict | None = None) -> list[tuple[str, list[str]]]:
+    """(tar name, command) per `mode: stream` entry; the command writes the tar to stdout.
+
+    Plain `docker run` (no TTY, no compose output) with the service container's volumes
+    mounted read-only, using the service image's tar.
+    """
+    deploy_dir = deploy_dir.resolve()
+    result = []
+    for service, path in _volume_entries(_load_config(deploy_dir, config), "stream"):
+        container = service_container(deploy_dir, service)
+        r = subprocess.run(["docker", "inspect", "-f", "{{.Image}}", container], capture_output=True, text=True)
         if r.returncode != 0:
-            raise RuntimeError(r.stderr or "docker compose run failed")
-        result.append(tar_path)
+            raise RuntimeError(f"docker inspect {container} failed: {r.stderr}")
+        cmd = [
+            "docker", "run", "--rm",
+            "--volumes-from", f"{container}:ro",
+            "--entrypoint", "tar",
+            r.stdout.strip(),
+            "cf", "-", "-C", path, ".",
+        ]
+        result.append((tar_name(service, path), cmd))
+    return result
+
+
+def volume_paths(deploy_dir: Path, config: dict | None = None) -> list[Path]:
+    """Host directories of `mode: native` entries, for restic to back up in place."""
+    deploy_dir = deploy_dir.resolve()
+    result = []
+    for service, path in _volume_entries(_load_config(deploy_dir, config), "native"):
+        source = volume_source(deploy_dir, service, path)
+        if not source.is_dir():
+            raise RuntimeError(f"{service}:{path}: {source} not readable (is {VOLUMES_ROOT} mounted in the worker?)")
+        result.append(source)
     return result
 
 
@@ -1,142 +1,221 @@
 """
 Backup flow: for each app with backup.yml, capture volumes and run restic backup.
 
-Repository:
-  - If RESTIC_REPOSITORY_BASE is set (e.g. sftp:uXXXXX@uXXXXX.your-storagebox.de): back up to
-    Storage Box at {base}:{app_slug}. Requires RESTIC_PASSWORD_FILE and SSH key at
-    /opt/iac/prefect/.ssh/storagebox_id_ed25519.
-  - Else: use local backend at /opt/iac/prefect/backups/{app_slug} with RESTIC_PASSWORD (default "local").
+Repository per app: see restic.py (local, or Storage Box with RESTIC_REPOSITORY_BASE).
+Retention (forget) and prune run in the separate maintenance flow (maintenance.py).
+
+Concurrency: up to BACKUP_APP_WORKERS apps run at once (default 2); pg_dump / tar captures
+across all apps share BACKUP_CAPTURE_SLOTS (default 1) so parallel apps do not saturate
+disk I/O. A failing app does not stop the others; the run fails at the end with a summary.
+
+Postgres and volume entries with `mode: stream` skip staging: restic runs pg_dump / tar
+itself (--stdin-from-command) and stores the output under the staged file name in its own
+snapshot. Volumes with `mode: native` are backed up from their host directory in place.
+All snapshots of one app run share a run:<id> tag, which restore uses to collect them.
+
+Change detection: before capturing, each app's databases (WAL position + row counters),
+volumes (inode/size/mtime tree hash) and backup.yml are fingerprinted. If all match the
+fingerprints stored in the deploy state index by the last successful backup, the app is
+skipped as "unchanged" (whole app, so every run snapshot stays complete). force=True
+captures everything.
 """
 
 from __future__ import annotations
 
+import hashlib
+import json
 import os
 import shutil
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
 
-import yaml
 from prefect import flow
 from prefect.logging import get_run_logger
 
-from .capture_postgres import capture_postgres
-from .capture_volumes import capture_volumes
-
-DEPLOY_ROOT = Path("/opt/iac/deploy")
-PREFECT_ROOT = Path("/opt/iac/prefect")
-# Persist under /opt/iac so backups survive worker container restarts (host mount).
-LOCAL_BACKUP_ROOT = PREFECT_ROOT / "backups"
-SSH_KEY = PREFECT_ROOT / ".ssh" / "storagebox_id_ed25519"
-
-
-def _restic_env(app_slug: str) -> dict[str, str]:
-    env = os.environ.copy()
-    base = os.environ.get("RESTIC_REPOSITORY_BASE", "").strip()
-    if base:
-        env["RESTIC_REPOSITORY"] = f"{base}:{app_slug}"
-        env["RESTIC_PASSWORD_FILE"] = os.environ.get("RESTIC_PASSWORD_FILE", str(PREFECT_ROOT / ".restic-password"))
-    else:
-        repo_dir = LOCAL_BACKUP_ROOT / app_slug
-        repo_dir.mkdir(parents=True, exist_ok=True)
-        env["RESTIC_REPOSITORY"] = str(repo_dir)
-        env["RESTIC_PASSWORD"] = os.environ.get("RESTIC_PASSWORD", "local")
-    return env
-
-
-def _sftp_args() -> list[str]:
-    if os.environ.get("RESTIC_REPOSITORY_BASE") and SSH_KEY.exists():
-        return ["-o", f"sftp.args=-i {SSH_KEY}"]
-    return []
+from common.deploy_state import DeployState
 
+from .capture_postgres import (
+    basebackup_tags,
+    capture_postgres,
+    commit_basebackups,
+    postgres_fingerprints,
+    postgres_streams,
+)
+from .capture_volumes import capture_volumes, volume_fingerprints, volume_paths, volume_streams
+from .restic import PREFECT_ROOT, restic_check, restic_env, restic_init_if_needed, restic_run, sftp_args
 
-def _restic_run(cmd: list[str], env: dict[str, str], timeout: int = 600) -> subprocess.CompletedProcess:
-    full = ["restic"] + _sftp_args() + cmd
-    return subprocess.run(full, env=env, capture_output=True, text=True, timeout=timeout)
-
-
-def _restic_check(r: subprocess.CompletedProcess, what: str) -> None:
-    if r.returncode != 0:
-        raise RuntimeError(f"{what} failed: {r.stderr or r.stdout}")
-
-
-def _restic_init_if_needed(env: dict[str, str], log) -> None:
-    """Initialize restic repo if it does not exist. Idempotent (no-op if already initialized)."""
-    r = _restic_run(["init"], env, timeout=60)
-    if r.returncode == 0:
-        return
-    err = (r.stderr or r.stdout or "").lower()
-    if "already exists" in err or "config file already exists" in err:
-        return
-    raise RuntimeError(f"restic init failed: {r.stderr or r.stdout}")
+DEPLOY_ROOT = Path("/opt/iac/deploy")
+# Per app: manifest + chain position of the last stored Postgres base backup (incrementals).
+BACKUP_STATE_ROOT = PREFECT_ROOT / "backup-state"
+APP_WORKERS = int(os.environ.get("BACKUP_APP_WORKERS") or 2)
+CAPTURE_SLOTS = int(os.environ.get("BACKUP_CAPTURE_SLOTS") or 1)
+
+
+def _stream_backup(name: str, cmd: list[str], env: dict[str, str], tags: list[str], cwd: Path) -> int:
+    """restic backup of cmd's stdout as file `name` (one snapshot). Returns bytes stored from stdin."""
+    full = ["restic"] + sftp_args() + ["backup", "--json", "--stdin-filename", name]
+    for tag in tags:
+        full += ["--tag", tag]
+    full += ["--stdin-from-command", "--", *cmd]
+    # restic fails (no snapshot) when the command exits non-zero.
+    r = subprocess.run(full, env=env, cwd=cwd, capture_output=True, text=True, timeout=3600)
+    restic_check(r, f"restic backup of {name}")
+    for line in reversed(r.stdout.splitlines()):
+        try:
+            msg = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if msg.get("message_type") == "summary":
+            size = int(msg.get("total_bytes_processed") or 0)
+            if size == 0:
+                raise RuntimeError(f"{name}: command produced 0 bytes (empty dump). stderr: {r.stderr}")
+            return size
+    return 0
 
 
-def _backup_app(app_slug: str, deploy_dir: Path, log) -> None:
-    backup_yml = deploy_dir / "backup.yml"
-    config = yaml.safe_load(backup_yml.read_text()) or {}
-    retention = config.get("retention") or {}
-    keep_daily = retention.get("keep_daily", 7)
-    keep_weekly = retention.get("keep_weekly", 4)
-    keep_monthly = retention.get("keep_monthly", 12)
+def _backup_app(app_slug: str, deploy_dir: Path, config: dict, log, capture_slots: threading.Semaphore) -> str:
+    """Back up one app (config = its backup.yml). Returns "ok", or "skipped" if nothing was captured.
 
+    Each capture step holds one of capture_slots (shared by all apps of the run).
+    """
     log.info("MEASURE: step=backup_start app=%s", app_slug)
-    env = _restic_env(app_slug)
+    env = restic_env(app_slug)
     log.info("Restic repo for %s: %s", app_slug, env.get("RESTIC_REPOSITORY", ""))
     staging = PREFECT_ROOT / "backup-staging" / app_slug
     if staging.exists():
         shutil.rmtree(staging)
     staging.mkdir(parents=True)
-    log.info("MEASURE: step=capture_postgres app=%s", app_slug)
-    capture_postgres(deploy_dir, staging)
-    log.info("MEASURE: step=capture_volumes app=%s", app_slug)
-    capture_volumes(deploy_dir, staging)
-    if not list(staging.iterdir()):
+    with capture_slots:
+        log.info("MEASURE: step=capture_postgres app=%s", app_slug)
+        capture_postgres(deploy_dir, staging, config, BACKUP_STATE_ROOT / app_slug)
+    volume_timings: dict[str, float] = {}
+    with capture_slots:
+        log.info("MEASURE: step=capture_volumes app=%s", app_slug)
+        capture_volumes(deploy_dir, staging, config, volume_timings)
+    for name, seconds in volume_timings.items():
+        log.info("MEASURE: step=capture_volume app=%s file=%s duration_s=%.1f", app_slug, name, seconds)
+    streams = postgres_streams(deploy_dir, config) + volume_streams(deploy_dir, config)
+    native_paths = volume_paths(deploy_dir, config)
+    has_files = any(staging.iterdir())
+    if not has_files and not streams and not native_paths:
         log.info("%s: no postgres dumps or volume tarballs, skipping restic", app_slug)
         shutil.rmtree(staging)
-        return
-
-    _restic_init_if_needed(env, log)
-    log.info("MEASURE: step=restic_backup app=%s", app_slug)
-    _restic_check(_restic_run(["backup", str(staging)], env), "restic backup")
-
-    log.info("MEASURE: step=restic_forget app=%s", app_slug)
-    _restic_check(
-        _restic_run(
-            [
-                "forget",
-                "--keep-daily",
-                str(keep_daily),
-                "--keep-weekly",
-                str(keep_weekly),
-                "--keep-monthly",
-                str(keep_monthly),
-            ],
-            env,
-        ),
-        "restic forget",
-    )
+        return "skipped"
+
+    restic_init_if_needed(env, log)
+    run_tag = f"run:{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}"
+    # The staged snapshot also carries pgchain:<service>:<chain> per base backup (restore finds the chain).
+    tag_args = [arg for tag in (run_tag, *basebackup_tags(staging)) for arg in ("--tag", tag)]
+    if has_files or native_paths:
+        # Native volume dirs are read here, so this step takes a capture slot too.
+        paths = ([str(staging)] if has_files else []) + [str(p) for p in native_paths]
+        log.info("MEASURE: step=restic_backup app=%s native_volumes=%d", app_slug, len(native_paths))
+        if native_paths:
+            with capture_slots:
+                r = restic_run(["backup", *tag_args, *paths], env, timeout=3600)
+        else:
+            r = restic_run(["backup", *tag_args, *paths], env)
+        restic_check(r, "restic backup")
+        commit_basebackups(staging, BACKUP_STATE_ROOT / app_slug)
+    for name, cmd in streams:
+        started = time.monotonic()
+        with capture_slots:
+            size = _stream_backup(name, cmd, env, [run_tag], deploy_dir)
+        log.info(
+            "MEASURE: step=restic_stream app=%s file=%s bytes=%d duration_s=%.1f",
+            app_slug, name, size, time.monotonic() - started,
+        )
 
-    log.info("MEASURE: step=restic_prune app=%s", app_slug)
-    _restic_check(_restic_run(["prune"], env, timeout=900), "restic prune")
     shutil.rmtree(staging)
     log.info("MEASURE: step=backup_done app=%s", app_slug)
+    return "ok"
+
+
+def _fingerprints(deploy_dir: Path, config: dict) -> dict[str, str | None]:
+    """Change fingerprints of an app: its backup config, each database and each volume."""
+    config_hash = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+    return {
+        "config": config_hash,
+        **postgres_fingerprints(deploy_dir, config),
+        **volume_fingerprints(deploy_dir, config),
+    }
+
+
+def _report_outcomes(outcomes: dict[str, tuple[str, float, str]], log) -> list[str]:
+    """Log one line per app (status, duration, error) and the counts. Returns the failed app slugs."""
+    counts: dict[str, int] = {}
+    for app_slug, (status, seconds, detail) in sorted(outcomes.items()):
+        counts[status] = counts.get(status, 0) + 1
+        line = f"{app_slug}: {status} in {seconds:.1f}s"
+        if detail.strip():
+            line += f": {detail.strip().splitlines()[0][:300]}"
+        (log.error if status == "failed" else log.info)(line)
+    log.info(
+        "MEASURE: step=backup_summary captured=%d unchanged=%d skipped=%d failed=%d",
+        counts.get("ok", 0), counts.get("unchanged", 0), counts.get("skipped", 0), counts.get("failed", 0),
+    )
+    return sorted(app for app, (status, _, _) in outcomes.items() if status == "failed")
 
 
 @flow
-def run_backup() -> None:
-    """For each app with backup.yml, capture postgres dumps and volumes, then back up via restic (local or Storage Box if configured)."""
+def run_backup(force: bool = False) -> None:
+    """For each app with backup.yml, capture postgres dumps and volumes, then back up via restic (local or Storage Box if configured).
+
+    Apps whose fingerprints match the last successful backup are skipped unless force is set.
+    """
     log = get_run_logger()
     if not DEPLOY_ROOT.is_dir():
         log.warning("Deploy root %s not found", DEPLOY_ROOT)
         return
 
-    for deploy_dir in sorted(DEPLOY_ROOT.iterdir()):
-        if not deploy_dir.is_dir():
-            continue
-        if not (deploy_dir / "backup.yml").exists():
-            continue
-        app_slug = deploy_dir.name
+    # Apps with backup.yml and their parsed config, from the deploy state index.
+    state = DeployState()
+    capture_slots = threading.Semaphore(max(1, CAPTURE_SLOTS))
+    outcomes: dict[str, tuple[str, float, str]] = {}
+
+    def backup_one(app: dict) -> tuple[str, float, str]:
+        app_slug = app["app"]
+        config = app["backup_config"] or {}
+        started = time.monotonic()
         try:
-            _backup_app(app_slug, deploy_dir, log)
+            # Taken before capturing: writes during the backup make the next run capture again.
+            fingerprints = _fingerprints(DEPLOY_ROOT / app_slug, config)
+            unknown = sorted(item for item, fp in fingerprints.items() if fp is None)
+            if not force and not unknown and fingerprints == state.fingerprints(app_slug):
+                log.info("%s: unchanged since the last backup, skipping", app_slug)
+                state.record_backup(app_slug, "unchanged")
+                return "unchanged", time.monotonic() - started, ""
+            if unknown:
+                log.info("%s: no fingerprint for %s, capturing", app_slug, ", ".join(unknown))
+            status = _backup_app(app_slug, DEPLOY_ROOT / app_slug, config, log, capture_slots)
         except Exception as e:
             log.exception("Backup failed for %s: %s", app_slug, e)
-            raise
+            state.record_backup(app_slug, "failed", str(e))
+            return "failed", time.monotonic() - started, str(e)
+        state.record_backup(app_slug, status)
+        if status == "ok":
+            # Incomplete fingerprints are not kept: the next run captures again.
+            state.record_fingerprints(app_slug, {} if unknown else fingerprints)
+        return status, time.monotonic() - started, ""
+
+    try:
+        state.sync()
+        apps = state.backup_apps()
+        log.info(
+            "Backing up %d app(s): app_workers=%d, capture_slots=%d, force=%s",
+            len(apps), APP_WORKERS, CAPTURE_SLOTS, force,
+        )
+        with ThreadPoolExecutor(max_workers=max(1, APP_WORKERS)) as executor:
+            futures = {executor.submit(backup_one, app): app["app"] for app in apps}
+            for future in as_completed(futures):
+                outcomes[futures[future]] = future.result()
+    finally:
+        state.close()
+
+    failed = _report_outcomes(outcomes, log)
+    if failed:
+        raise RuntimeError(f"backup failed for {len(failed)} of {len(outcomes)} app(s): {', '.join(failed)}")
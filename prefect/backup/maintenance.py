@@ -0,0 +1,216 @@
+"""
+Backup maintenance flow: restic forget + prune per app repository, on its own schedule.
+
+Kept out of the nightly backup: prune is the most expensive restic operation and holds
+the repository's exclusive lock. Retention comes from each app's backup.yml (deploy state
+index). Prune is bounded with --max-unused (unused space tolerated, so mostly-used packs
+are not rewritten) and --max-repack-size (cap on data repacked per run; the rest waits
+for the next run). Both are flow parameters. In two-tier mode (restic.two_tier) the
+Storage Box replica gets the same forget + prune after the local repo.
+
+Incremental base backups (capture_postgres, `mode: basebackup`) only restore with every
+earlier backup of their chain, but forget judges each snapshot on its own. So forget runs
+as a dry run first, and every pgchain:<service>:<chain> tag of a kept snapshot is passed
+as --keep-tag: whole chains stay. Afterwards the chains of the newest weekly snapshot are
+checked for completeness (a full plus every incremental up to it).
+
+Each app logs a MEASURE line (duration, bytes repacked / removed / remaining, parsed from
+prune's report) and appends it to MAINTENANCE_HISTORY_PATH. A failing app does not stop
+the others; the run fails at the end with a summary.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from prefect import flow
+from prefect.logging import get_run_logger
+
+from common.deploy_state import DeployState
+
+from .restic import PREFECT_ROOT, replica_env, restic_check, restic_env, restic_repo_exists, restic_run, two_tier
+
+DEPLOY_ROOT = Path("/opt/iac/deploy")
+MAINTENANCE_HISTORY_PATH = PREFECT_ROOT / "backup-maintenance.jsonl"
+MAX_UNUSED = "10%"
+MAX_REPACK_SIZE = "2G"
+# Wait for a running backup's lock instead of failing.
+RETRY_LOCK = "30m"
+
+_SIZE_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3, "TiB": 1024**4}
+# e.g. "to repack:           152 blobs / 1.234 MiB"
+_PRUNE_LINE_RE = re.compile(r"^(to repack|total prune|remaining):\s+\d+ blobs / ([\d.]+) (B|KiB|MiB|GiB|TiB)\s*$")
+_PRUNE_KEYS = {"to repack": "repack_bytes", "total prune": "removed_bytes", "remaining": "remaining_bytes"}
+
+
+def _prune_stats(output: str) -> dict[str, int | None]:
+    """repack_bytes / removed_bytes / remaining_bytes from restic prune's report (None if absent)."""
+    stats: dict[str, int | None] = dict.fromkeys(_PRUNE_KEYS.values())
+    for line in output.splitlines():
+        match = _PRUNE_LINE_RE.match(line.strip())
+        if match:
+            stats[_PRUNE_KEYS[match.group(1)]] = int(float(match.group(2)) * _SIZE_UNITS[match.group(3)])
+    return stats
+
+
+def _record(record: dict, log) -> None:
+    try:
+        MAINTENANCE_HISTORY_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with MAINTENANCE_HISTORY_PATH.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        log.warning("Could not record maintenance metrics in %s: %s", MAINTENANCE_HISTORY_PATH, e)
+
+
+def _chain_tags(snapshot: dict) -> list[str]:
+    return [tag for tag in snapshot.get("tags") or [] if tag.startswith("pgchain:")]
+
+
+def _chain_seq(env: dict[str, str], snapshot: dict, service: str) -> int | None:
+    """seq of the service's base backup in snapshot (from its staged .json metadata)."""
+    for path in snapshot.get("paths") or []:
+        r = restic_run(["dump", snapshot["id"], f"{path}/postgres_{service}.base.json"], env)
+        if r.returncode == 0:
+            try:
+                return int(json.loads(r.stdout)["seq"])
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                return None
+    return None
+
+
+def _check_weekly_chains(app_slug: str, tier: str, env: dict[str, str], groups: list[dict], log) -> None:
+    """Raise unless every chain of the newest kept weekly snapshot is complete up to it."""
+    weekly = [
+        reason["snapshot"]
+        for group in groups
+        for reason in group.get("reasons") or []
+        if "weekly snapshot" in (reason.get("matches") or []) and _chain_tags(reason.get("snapshot") or {})
+    ]
+    if not weekly:
+        return
+    newest = max(weekly, key=lambda snap: snap.get("time") or "")
+    for tag in _chain_tags(newest):
+        service = tag.split(":")[1]
+        target = _chain_seq(env, newest, service)
+        if target is None:
+            raise RuntimeError(f"{tier} {tag}: base backup metadata missing in snapshot {newest['id'][:8]}")
+        r = restic_run(["snapshots", "--json", "--tag", tag], env)
+        restic_check(r, "restic snapshots")
+        seqs = {_chain_seq(env, snap, service) for snap in json.loads(r.stdout or "[]") or []}
+        missing = [seq for seq in range(target + 1) if seq not in seqs]
+        if missing:
+            raise RuntimeError(
+                f"{tier} {tag}: weekly snapshot {newest['id'][:8]} not restorable, missing backups {missing}"
+            )
+        log.info("%s: %s %s complete up to weekly snapshot %s (seq %d)", app_slug, tier, tag, newest["id"][:8], target)
+
+
+def _maintain_app(app_slug: str, config: dict, max_unused: str, max_repack_size: str, log) -> None:
+    """forget + bounded prune of app's repo, and of its replica in two-tier mode."""
+    tiers = [("local" if two_tier() else "primary", restic_env(app_slug))]
+    if two_tier():
+        tiers.append(("replica", replica_env(app_slug)))
+    errors = []
+    for tier, env in tiers:
+        try:
+            _maintain_repo(app_slug, tier, env, config, max_unused, max_repack_size, log)
+        except Exception as e:
+            # The other tier still gets its forget + prune.
+            errors.append(f"{tier}: {e}")
+    if errors:
+        raise RuntimeError("; ".join(errors))
+
+
+def _maintain_repo(
+    app_slug: str, tier: str, env: dict[str, str], config: dict, max_unused: str, max_repack_size: str, log
+) -> str:
+    """forget (backup.yml retention) + bounded prune for one repo. Returns "ok" or "skipped" (no repo)."""
+    if not restic_repo_exists(env):
+        log.info("%s: no %s restic repository yet, skipping", app_slug, tier)
+        return "skipped"
+    retention = config.get("retention") or {}
+    policy = [
+        "--keep-daily", str(retention.get("keep_daily", 7)),
+        "--keep-weekly", str(retention.get("keep_weekly", 4)),
+        "--keep-monthly", str(retention.get("keep_monthly", 12)),
+    ]
+
+    started = time.monotonic()
+    r = restic_run(["forget", "--retry-lock", RETRY_LOCK, "--dry-run", "--json", *policy], env, timeout=1800)
+    restic_check(r, "restic forget --dry-run")
+    groups = json.loads(r.stdout or "[]") or []
+    chains = sorted(
+        {tag for group in groups for snap in group.get("keep") or [] for tag in _chain_tags(snap)}
+    )
+    keep_chains = [arg for tag in chains for arg in ("--keep-tag", tag)]
+    restic_check(
+        restic_run(["forget", "--retry-lock", RETRY_LOCK, *policy, *keep_chains], env, timeout=1800),
+        "restic forget",
+    )
+    forget_s = time.monotonic() - started
+    if chains:
+        log.info("%s: %s kept %d base backup chain(s) whole", app_slug, tier, len(chains))
+
+    started = time.monotonic()
+    r = restic_run(
+        ["prune", "--retry-lock", RETRY_LOCK, "--max-unused", max_unused, "--max-repack-size", max_repack_size],
+        env,
+        timeout=3 * 3600,
+    )
+    restic_check(r, "restic prune")
+    prune_s = time.monotonic() - started
+    stats = _prune_stats(r.stdout)
+    log.info(
+        "MEASURE: step=restic_prune app=%s tier=%s forget_s=%.1f prune_s=%.1f"
+        " repack_bytes=%s removed_bytes=%s remaining_bytes=%s",
+        app_slug, tier, forget_s, prune_s,
+        *(stats[k] if stats[k] is not None else "unknown" for k in ("repack_bytes", "removed_bytes", "remaining_bytes")),
+    )
+    _record(
+        {
+            "at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "app": app_slug,
+            "tier": tier,
+            "forget_s": round(forget_s, 1),
+            "prune_s": round(prune_s, 1),
+            "max_unused": max_unused,
+            "max_repack_size": max_repack_size,
+            **stats,
+        },
+        log,
+    )
+    # After prune, so a broken chain (from before whole chains were kept) does not stop it.
+    _check_weekly_chains(app_slug, tier, env, groups, log)
+    return "ok"
+
+
+@flow
+def run_backup_maintenance(max_unused: str = MAX_UNUSED, max_repack_size: str = MAX_REPACK_SIZE) -> None:
+    """Apply retention (restic forget) and a bounded restic prune to every app's backup repository."""
+    log = get_run_logger()
+    if not DEPLOY_ROOT.is_dir():
+        log.warning("Deploy root %s not found", DEPLOY_ROOT)
+        return
+
+    state = DeployState()
+    try:
+        state.sync()
+        apps = state.backup_apps()
+    finally:
+        state.close()
+
+    log.info("Maintaining %d repo(s): max_unused=%s, max_repack_size=%s", len(apps), max_unused, max_repack_size)
+    failed: dict[str, str] = {}
+    for app in apps:
+        app_slug = app["app"]
+        try:
+            _maintain_app(app_slug, app["backup_config"] or {}, max_unused, max_repack_size, log)
+        except Exception as e:
+            log.exception("Maintenance failed for %s: %s", app_slug, e)
+            failed[app_slug] = str(e)
+    if failed:
+        raise RuntimeError(f"maintenance failed for {len(failed)} of {len(apps)} repo(s): {', '.join(sorted(failed))}")
@@ -0,0 +1,131 @@
+"""
+Backup replication flow (two-tier mode): restic copy of each app's local snapshots to its
+Storage Box repository.
+
+With RESTIC_TWO_TIER=1 and RESTIC_REPOSITORY_BASE set, the nightly backup only writes the
+local repo (fast, no WAN in the backup window); this flow runs on its own schedule and
+copies what the remote does not have yet. restic copy skips snapshots already copied, so
+an interrupted run resumes with the rest on the next one. Replica repos are initialized
+with the local repo's chunker params so copies deduplicate.
+
+Per app it logs a MEASURE line (duration, snapshots copied, still pending, replication
+lag = age of the oldest local snapshot not yet on the remote) and appends it to
+REPLICATION_HISTORY_PATH.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from prefect import flow
+from prefect.logging import get_run_logger
+
+from common.deploy_state import DeployState
+
+from .restic import (
+    PREFECT_ROOT,
+    replica_env,
+    restic_check,
+    restic_env,
+    restic_init_if_needed,
+    restic_repo_exists,
+    restic_run,
+    two_tier,
+)
+
+DEPLOY_ROOT = Path("/opt/iac/deploy")
+REPLICATION_HISTORY_PATH = PREFECT_ROOT / "backup-replication.jsonl"
+# Wait for a backup / prune lock instead of failing.
+RETRY_LOCK = "30m"
+
+# restic prints nanoseconds; datetime takes microseconds.
+_FRACTION_RE = re.compile(r"(\.\d{6})\d+")
+
+
+def _snapshot_time(snapshot: dict) -> datetime:
+    return datetime.fromisoformat(_FRACTION_RE.sub(r"\1", snapshot["time"]).replace("Z", "+00:00"))
+
+
+def _snapshots(env: dict[str, str]) -> list[dict]:
+    r = restic_run(["snapshots", "--json", "--retry-lock", RETRY_LOCK], env, timeout=1800)
+    restic_check(r, "restic snapshots")
+    return json.loads(r.stdout or "[]") or []
+
+
+def _pending(local: dict[str, str], remote: dict[str, str]) -> tuple[int, float]:
+    """(local snapshots not on the remote, lag in seconds = age of the oldest of them, 0 if none)."""
+    copied = {s.get("original") or s["id"] for s in _snapshots(remote)}
+    pending = [s for s in _snapshots(local) if s["id"] not in copied]
+    if not pending:
+        return 0, 0.0
+    oldest = min(_snapshot_time(s) for s in pending)
+    return len(pending), (datetime.now(timezone.utc) - oldest).total_seconds()
+
+
+def _replicate_app(app_slug: str, log) -> str:
+    """Copy app's local snapshots to its replica. Returns "ok" or "skipped" (no local repo)."""
+    local = restic_env(app_slug)
+    if not restic_repo_exists(local):
+        log.info("%s: no local restic repository yet, skipping", app_slug)
+        return "skipped"
+    remote = replica_env(app_slug)
+    restic_init_if_needed(remote, log, copy_chunker_params=True)
+
+    pending_before, _ = _pending(local, remote)
+    started = time.monotonic()
+    restic_check(restic_run(["copy", "--retry-lock", RETRY_LOCK], remote, timeout=6 * 3600), "restic copy")
+    duration = time.monotonic() - started
+    pending_after, lag = _pending(local, remote)
+    log.info(
+        "MEASURE: step=restic_copy app=%s duration_s=%.1f copied=%d pending=%d lag_s=%.0f",
+        app_slug, duration, pending_before - pending_after, pending_after, lag,
+    )
+    record = {
+        "at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "app": app_slug,
+        "duration_s": round(duration, 1),
+        "copied": pending_before - pending_after,
+        "pending": pending_after,
+        "lag_s": round(lag),
+    }
+    try:
+        REPLICATION_HISTORY_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with REPLICATION_HISTORY_PATH.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        log.warning("Could not record replication metrics in %s: %s", REPLICATION_HISTORY_PATH, e)
+    return "ok"
+
+
+@flow
+def run_backup_replication() -> None:
+    """Two-tier mode: copy new local snapshots of every app to the Storage Box."""
+    log = get_run_logger()
+    if not two_tier():
+        log.info("Two-tier backups off (RESTIC_TWO_TIER with RESTIC_REPOSITORY_BASE), nothing to replicate")
+        return
+    if not DEPLOY_ROOT.is_dir():
+        log.warning("Deploy root %s not found", DEPLOY_ROOT)
+        return
+
+    state = DeployState()
+    try:
+        state.sync()
+        apps = state.backup_apps()
+    finally:
+        state.close()
+
+    failed: dict[str, str] = {}
+    for app in apps:
+        app_slug = app["app"]
+        try:
+            _replicate_app(app_slug, log)
+        except Exception as e:
+            log.exception("Replication failed for %s: %s", app_slug, e)
+            failed[app_slug] = str(e)
+    if failed:
+        raise RuntimeError(f"replication failed for {len(failed)} of {len(apps)} app(s): {', '.join(sorted(failed))}")
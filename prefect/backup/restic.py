@@ -0,0 +1,98 @@
+"""
+Restic helpers shared by the backup, maintenance and replication flows: per-app repository
+env and command runner.
+
+Repository:
+  - If RESTIC_REPOSITORY_BASE is set (e.g. sftp:uXXXXX@uXXXXX.your-storagebox.de): back up to
+    Storage Box at {base}:{app_slug}. Requires RESTIC_PASSWORD_FILE and SSH key at
+    /opt/iac/prefect/.ssh/storagebox_id_ed25519.
+  - Else: use local backend at /opt/iac/prefect/backups/{app_slug} with RESTIC_PASSWORD (default "local").
+  - Two-tier (RESTIC_TWO_TIER=1 with RESTIC_REPOSITORY_BASE): back up to the local repo;
+    the replication flow copies snapshots to the Storage Box repo (replica_env) with
+    `restic copy`.
+"""
+
+from __future__ import annotations
+
+import os
+import subprocess
+from pathlib import Path
+
+PREFECT_ROOT = Path("/opt/iac/prefect")
+# Persist under /opt/iac so backups survive worker container restarts (host mount).
+LOCAL_BACKUP_ROOT = PREFECT_ROOT / "backups"
+SSH_KEY = PREFECT_ROOT / ".ssh" / "storagebox_id_ed25519"
+
+
+def two_tier() -> bool:
+    """True if backups go to the local repo and are replicated to RESTIC_REPOSITORY_BASE."""
+    enabled = os.environ.get("RESTIC_TWO_TIER", "").strip().lower() in ("1", "true", "yes")
+    return enabled and bool(os.environ.get("RESTIC_REPOSITORY_BASE", "").strip())
+
+
+def _local_env(app_slug: str) -> dict[str, str]:
+    env = os.environ.copy()
+    repo_dir = LOCAL_BACKUP_ROOT / app_slug
+    repo_dir.mkdir(parents=True, exist_ok=True)
+    env["RESTIC_REPOSITORY"] = str(repo_dir)
+    env["RESTIC_PASSWORD"] = os.environ.get("RESTIC_PASSWORD", "local")
+    return env
+
+
+def _remote_env(app_slug: str) -> dict[str, str]:
+    env = os.environ.copy()
+    env["RESTIC_REPOSITORY"] = f"{os.environ['RESTIC_REPOSITORY_BASE'].strip()}:{app_slug}"
+    env["RESTIC_PASSWORD_FILE"] = os.environ.get("RESTIC_PASSWORD_FILE", str(PREFECT_ROOT / ".restic-password"))
+    return env
+
+
+def restic_env(app_slug: str) -> dict[str, str]:
+    """Env for the repo backups are written to (remote only when not two-tier)."""
+    if os.environ.get("RESTIC_REPOSITORY_BASE", "").strip() and not two_tier():
+        return _remote_env(app_slug)
+    return _local_env(app_slug)
+
+
+def replica_env(app_slug: str) -> dict[str, str]:
+    """Two-tier: env for the Storage Box repo, with the local repo as RESTIC_FROM_* (restic copy / init)."""
+    local = _local_env(app_slug)
+    env = _remote_env(app_slug)
+    env["RESTIC_FROM_REPOSITORY"] = local["RESTIC_REPOSITORY"]
+    env["RESTIC_FROM_PASSWORD"] = local["RESTIC_PASSWORD"]
+    return env
+
+
+def sftp_args() -> list[str]:
+    if os.environ.get("RESTIC_REPOSITORY_BASE") and SSH_KEY.exists():
+        return ["-o", f"sftp.args=-i {SSH_KEY}"]
+    return []
+
+
+def restic_run(cmd: list[str], env: dict[str, str], timeout: int = 600) -> subprocess.CompletedProcess:
+    full = ["restic"] + sftp_args() + cmd
+    return subprocess.run(full, env=env, capture_output=True, text=True, timeout=timeout)
+
+
+def restic_check(r: subprocess.CompletedProcess, what: str) -> None:
+    if r.returncode != 0:
+        raise RuntimeError(f"{what} failed: {r.stderr or r.stdout}")
+
+
+def restic_init_if_needed(env: dict[str, str], log, copy_chunker_params: bool = False) -> None:
+    """Initialize restic repo if it does not exist. Idempotent (no-op if already initialized).
+
+    copy_chunker_params: take the chunker params of RESTIC_FROM_REPOSITORY, so snapshots
+    copied from it deduplicate (replica repos).
+    """
+    r = restic_run(["init", "--copy-chunker-params"] if copy_chunker_params else ["init"], env, timeout=60)
+    if r.returncode == 0:
+        return
+    err = (r.stderr or r.stdout or "").lower()
+    if "already exists" in err or "config file already exists" in err:
+        return
+    raise RuntimeError(f"restic init failed: {r.stderr or r.stdout}")
+
+
+def restic_repo_exists(env: dict[str, str]) -> bool:
+    """True if the repository in env is initialized (reads its config)."""
+    return restic_run(["cat", "config"], env, timeout=120).returncode == 0
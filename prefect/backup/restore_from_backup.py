@@ -3,8 +3,16 @@
 
 RESTORE_TMP_PARENT (default /opt/iac/prefect/.restore-work) should stay under /opt/iac so
 `docker compose cp` paths match the host (worker uses the Docker socket).
+
+A backup run can span several snapshots (streamed dumps are their own snapshot); all
+snapshots sharing the chosen snapshot's run:<id> tag are restored into one tree.
+
+Postgres base backups (mode: basebackup) are physical: the chain up to the chosen backup
+(full + incrementals, found by their pgchain:<service>:<chain> tag) is combined with
+pg_combinebackup into the service's PGDATA while the service is stopped.
 """
 import argparse
+import json
 import os
 import shutil
 import subprocess
@@ -14,12 +22,123 @@ from pathlib import Path
 import yaml
 from dotenv import dotenv_values
 
+# Runs as a script from flows/backup (task backup:restore), so sibling modules import directly.
+from capture_volumes import volume_source
+
 
 def _path_slug(path: str) -> str:
     """Volume tarball suffix; must match capture_volumes._volume_slug."""
     return path.strip("/").replace("/", "_") or "root"
 
 
+def _run_snapshots(snapshot: str, restic_env: dict[str, str]) -> list[str]:
+    """IDs of all snapshots in snapshot's backup run (its run:<id> tag), or just its own ID."""
+    def snapshots(*args: str) -> list[dict]:
+        r = subprocess.run(
+            ["restic", "snapshots", "--json", *args],
+            env=restic_env, capture_output=True, text=True, check=True,
+        )
+        return json.loads(r.stdout or "[]") or []
+
+    found = snapshots(snapshot)
+    if not found:
+        raise SystemExit(f"Snapshot not found: {snapshot}")
+    chosen = found[-1]
+    run_tags = [t for t in chosen.get("tags") or [] if t.startswith("run:")]
+    if not run_tags:
+        return [chosen["id"]]
+    return [s["id"] for s in snapshots("--tag", run_tags[0])]
+
+
+def _find_capture(tmp: Path, staging: Path, name: str) -> Path | None:
+    """Capture file/dir by name: under the staging path, else anywhere in the restore tree (stdin snapshots)."""
+    if (staging / name).exists():
+        return staging / name
+    return next(tmp.rglob(name), None)
+
+
+def _find_dump(tmp: Path, staging: Path, service: str) -> Path | None:
+    """Dump of a service in any capture format: custom file, directory, or streamed directory tar.
+
+    A streamed directory tar is extracted next to it and the directory returned.
+    Names must match capture_postgres.dump_name.
+    """
+    for name in (f"postgres_{service}.dump", f"postgres_{service}.dir"):
+        found = _find_capture(tmp, staging, name)
+        if found is not None:
+            return found
+    tar_path = _find_capture(tmp, staging, f"postgres_{service}.dir.tar")
+    if tar_path is None:
+        return None
+    extract_root = tmp / f"_pgextract_{service}"
+    extract_root.mkdir()
+    r = subprocess.run(["tar", "xf", str(tar_path), "-C", str(extract_root)], capture_output=True, text=True)
+    if r.returncode != 0:
+        raise SystemExit(f"Unreadable dump tar: {tar_path}\n{r.stderr}")
+    return extract_root
+
+
+def _basebackup_chain(tmp: Path, staging: Path, service: str, restic_env: dict[str, str]) -> list[Path]:
+    """Base backup dirs of the restored run's chain, full first ([] if the run has none).
+
+    Earlier backups of the chain are restored from their own snapshots (base backup only).
+    Names must match capture_postgres.basebackup_name.
+    """
+    name = f"postgres_{service}.base"
+    meta_path = _find_capture(tmp, staging, f"{name}.json")
+    if meta_path is None:
+        return []
+    meta = json.loads(meta_path.read_text())
+    chain = {meta["seq"]: meta_path.parent / name}
+    if meta["seq"] > 0:
+        r = subprocess.run(
+            ["restic", "snapshots", "--json", "--tag", f"pgchain:{service}:{meta['chain']}"],
+            env=restic_env, capture_output=True, text=True, check=True,
+        )
+        for snap in json.loads(r.stdout or "[]") or []:
+            target = tmp / f"_chain_{service}" / snap["id"][:8]
+            subprocess.run(
+                ["restic", "restore", snap["id"], "--target", str(target), "--include", f"{name}*"],
+                env=restic_env, check=True,
+            )
+            found = next(target.rglob(f"{name}.json"), None)
+            seq = json.loads(found.read_text())["seq"] if found is not None else meta["seq"]
+            if seq < meta["seq"]:
+                chain[seq] = found.parent / name
+    missing = [seq for seq in range(meta["seq"] + 1) if seq not in chain]
+    if missing:
+        raise SystemExit(f"{service}: base backup chain {meta['chain']} incomplete, missing backups {missing}")
+    return [chain[seq] for seq in range(meta["seq"] + 1)]
+
+
+def _restore_basebackup(deploy_dir: Path, compose: list[str], service: str, chain: list[Path]) -> None:
+    """Stop the service, replace its PGDATA with the (combined) chain, start it again.
+
+    Runs in a one-off container of the service image with the chain dirs bind-mounted
+    (restore paths under /opt/iac match the host).
+    """
+    mounts: list[str] = []
+    for i, backup_dir in enumerate(chain):
+        mounts += ["-v", f"{backup_dir}:/restore-chain/{i}:ro"]
+    if len(chain) == 1:
+        fill = 'cp -a /restore-chain/0/. "$PGDATA"/'
+    else:
+        fill = 'pg_combinebackup -o "$PGDATA" ' + " ".join(f"/restore-chain/{i}" for i in range(len(chain)))
+    script = (
+        'set -e; : "${PGDATA:=/var/lib/postgresql/data}"; '
+        f'find "$PGDATA" -mindepth 1 -delete; {fill}; '
+        'chown -R postgres:postgres "$PGDATA"; chmod 700 "$PGDATA"'
+    )
+    subprocess.run(compose + ["stop", service], cwd=deploy_dir, check=True)
+    try:
+        subprocess.run(
+            compose + ["run", "--rm", "--no-deps", "-T", *mounts, "--entrypoint", "sh", service, "-c", script],
+            cwd=deploy_dir, check=True,
+        )
+    finally:
+        subprocess.run(compose + ["start", service], cwd=deploy_dir, check=False)
+
+
 def main() -> None:
     p = argparse.ArgumentParser(description="Restore from restic backup")
     p.add_argument("app_slug", help="App slug (e.g. tientje-ketama)")
@@ -69,13 +188,16 @@ def main() -> None:
         restic_env = os.environ.copy()
         restic_env["RESTIC_REPOSITORY"] = str(repo.resolve())
         restic_env["RESTIC_PASSWORD"] = password
-        subprocess.run(
-            ["restic", "restore", args.snapshot, "--target", str(tmp)],
-            env=restic_env,
-            check=True,
-        )
+        snapshot_ids = _run_snapshots(args.snapshot, restic_env)
+        for snapshot_id in snapshot_ids:
+            subprocess.run(
+                ["restic", "restore", snapshot_id, "--target", str(tmp)],
+                env=restic_env,
+                check=True,
+            )
         staging = tmp.joinpath(*prefect_parts, "backup-staging", args.app_slug)
-        if not staging.is_dir():
+        # A run with only streamed / native captures has no staging tree.
+        if not staging.is_dir() and not any(tmp.iterdir()):
             raise SystemExit(f"Could not find restore root: {staging}")
         compose = ["docker", "compose", "--project-directory", str(deploy_dir)]
 
@@ -86,25 +208,40 @@ def main() -> None:
                 db = env.get(entry.get("db_env") or "", "")
                 if not service:
                     continue
-                dump = staging / f"postgres_{service}.dump"
-                if not dump.is_file():
-                    print(f"Dump not found: {dump}")
+                if entry.get("mode") == "basebackup":
+                    chain = _basebackup_chain(tmp, staging, service, restic_env)
+                    if not chain:
+                        print(f"Base backup not found: {staging / f'postgres_{service}.base'}")
+                        continue
+                    print(f"Restoring DB: {service} (base backup, chain of {len(chain)})")
+                    _restore_basebackup(deploy_dir, compose, service, chain)
                     continue
-                print(f"Restoring DB: {service}")
-                container_dump = "/tmp/restore.dump"
+                dump = _find_dump(tmp, staging, service)
+                if dump is None:
+                    print(f"Dump not found: {staging / f'postgres_{service}.dump'}")
+                    continue
+                # Directory format (-F d) restores with the entry's jobs; pg_restore -j works
+                # for custom-format files too.
+                jobs = max(1, int(entry.get("jobs") or 1))
+                print(f"Restoring DB: {service} ({'directory' if dump.is_dir() else 'custom'} format, jobs={jobs})")
+                container_dump = "/tmp/restore.dir" if dump.is_dir() else "/tmp/restore.dump"
+                subprocess.run(
+                    compose + ["exec", "-T", service, "rm", "-rf", container_dump],
+                    cwd=deploy_dir, check=False,
+                )
                 subprocess.run(
                     compose + ["cp", str(dump), f"{service}:{container_dump}"],
                     cwd=deploy_dir, check=True,
                 )
                 try:
                     subprocess.run(
-                        compose + ["exec", "-T", service, "pg_restore", "-U", user, "-d", db,
+                        compose + ["exec", "-T", service, "pg_restore", "-U", user, "-d", db, "-j", str(jobs),
                                    "--clean", "--if-exists", "--no-owner", "--no-acl", container_dump],
                         cwd=deploy_dir, check=True,
                     )
                 finally:
                     subprocess.run(
-                        compose + ["exec", "-T", service, "rm", "-f", container_dump],
+                        compose + ["exec", "-T", service, "rm", "-rf", container_dump],
                         cwd=deploy_dir, check=False,
                     )
         if do_vol:
@@ -113,9 +250,22 @@ def main() -> None:
                 if not service or not path:
                     continue
                 slug = _path_slug(path)
-                tar_path = staging / f"{service}_{slug}.tar"
-                if not tar_path.is_file():
-                    print(f"Volume tar not found: {tar_path}")
+                if entry.get("mode") == "native":
+                    # Backed up in place: the volume's host dir sits under the restore tree.
+                    source = tmp / volume_source(deploy_dir, service, path).relative_to("/")
+                    if not source.is_dir():
+                        print(f"Volume dir not found in snapshot: {source}")
+                        continue
+                    print(f"Restoring volume: {service} {path}")
+                    subprocess.run(
+                        compose + ["cp", f"{source}/.", f"{service}:{path}/"],
+                        cwd=deploy_dir,
+                        check=True,
+                    )
+                    continue
+                tar_path = _find_capture(tmp, staging, f"{service}_{slug}.tar")
+                if tar_path is None:
+                    print(f"Volume tar not found: {staging / f'{service}_{slug}.tar'}")
                     continue
                 print(f"Restoring volume: {service} {path}")
                 extract_root = tmp / f"_vextract_{service}_{slug}"
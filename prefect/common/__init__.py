@@ -0,0 +1 @@
+# Shared helpers for flows and scripts/ (stdlib + PyYAML only; no Prefect imports).
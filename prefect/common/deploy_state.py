@@ -0,0 +1,207 @@
+"""
+Deployment state index: one SQLite file with a row per app under /opt/iac/deploy.
+
+Holds what the flows and tools otherwise re-derive from scattered files: image repo, tag
+and digest (deploy-info.yml), backup config (backup.yml, stored as JSON), the result of
+the last backup and the change fingerprints of its databases/volumes. sync() is
+incremental: it stats deploy-info.yml and backup.yml per app dir and only re-parses files
+whose mtime changed; rows of removed apps are dropped.
+
+Writers: the deploy playbook (`python3 -m common.deploy_state sync` after
+record-deployment), the prune and backup flows (sync at start; backup records results).
+Readers query by app; `dump` prints all rows as JSON for SSH callers (read-only, no sync).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+DEPLOY_ROOT = Path("/opt/iac/deploy")
+STATE_PATH = DEPLOY_ROOT / ".deploy-state.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS apps (
+    app TEXT PRIMARY KEY,
+    workspace TEXT NOT NULL DEFAULT '',
+    image_repo TEXT NOT NULL DEFAULT '',
+    image_tag TEXT NOT NULL DEFAULT '',
+    image_digest TEXT NOT NULL DEFAULT '',
+    deployed_at TEXT NOT NULL DEFAULT '',
+    deploy_info_mtime INTEGER NOT NULL DEFAULT 0,
+    backup_config TEXT,
+    backup_mtime INTEGER NOT NULL DEFAULT 0,
+    last_backup_at TEXT NOT NULL DEFAULT '',
+    last_backup_status TEXT NOT NULL DEFAULT '',
+    last_backup_detail TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    app TEXT NOT NULL,
+    item TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (app, item)
+);
+"""
+
+
+def _mtime(path: Path) -> int:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _load_yaml(path: Path, base: bool = False) -> dict:
+    # Imported here: `dump` runs under the server's system python, which may lack PyYAML.
+    import yaml
+
+    loader = yaml.BaseLoader if base else yaml.SafeLoader
+    try:
+        data = yaml.load(path.read_text(), Loader=loader) or {}
+    except (OSError, yaml.YAMLError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _deploy_info(path: Path) -> dict[str, str]:
+    # BaseLoader: values as written (a tag like 0123456 or a timestamp stays a string).
+    data = _load_yaml(path, base=True)
+    image = data.get("image") or {}
+    digest = str(image.get("digest") or "").strip()
+    if digest and not digest.startswith("sha256:"):
+        digest = f"sha256:{digest}"
+    return {
+        "workspace": str(data.get("workspace") or ""),
+        "image_repo": str(image.get("repo") or ""),
+        "image_tag": str(image.get("tag") or ""),
+        "image_digest": digest,
+        "deployed_at": str((data.get("deployment") or {}).get("deployed_at") or ""),
+    }
+
+
+def _row(row: sqlite3.Row) -> dict:
+    data = dict(row)
+    data["backup_config"] = json.loads(data["backup_config"]) if data["backup_config"] else None
+    data.pop("deploy_info_mtime", None)
+    data.pop("backup_mtime", None)
+    return data
+
+
+class DeployState:
+    """Thread-safe handle on the state index (one connection, serialized)."""
+
+    def __init__(self, path: Path = STATE_PATH, deploy_root: Path = DEPLOY_ROOT, read_only: bool = False):
+        self.path = path
+        self.deploy_root = deploy_root
+        self._lock = threading.Lock()
+        if read_only:
+            self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, timeout=30)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.executescript(_SCHEMA)
+            os.chmod(path, 0o644)
+        self._db.row_factory = sqlite3.Row
+
+    def close(self) -> None:
+        self._db.close()
+
+    def sync(self) -> int:
+        """Refresh rows from the app dirs whose deploy-info.yml/backup.yml changed. Returns rows changed."""
+        dirs = {}
+        if self.deploy_root.is_dir():
+            dirs = {d.name: d for d in self.deploy_root.iterdir() if d.is_dir() and not d.name.startswith(".")}
+        changed = 0
+        with self._lock, self._db:
+            known = {
+                r["app"]: (r["deploy_info_mtime"], r["backup_mtime"])
+                for r in self._db.execute("SELECT app, deploy_info_mtime, backup_mtime FROM apps")
+            }
+            for app in set(known) - set(dirs):
+                self._db.execute("DELETE FROM apps WHERE app = ?", (app,))
+                self._db.execute("DELETE FROM fingerprints WHERE app = ?", (app,))
+                changed += 1
+            for app, app_dir in sorted(dirs.items()):
+                info_mtime = _mtime(app_dir / "deploy-info.yml")
+                backup_mtime = _mtime(app_dir / "backup.yml")
+                if known.get(app) == (info_mtime, backup_mtime):
+                    continue
+                self._db.execute("INSERT OR IGNORE INTO apps (app) VALUES (?)", (app,))
+                if known.get(app, (None, None))[0] != info_mtime:
+                    info = _deploy_info(app_dir / "deploy-info.yml")
+                    self._db.execute(
+                        "UPDATE apps SET workspace = :workspace, image_repo = :image_repo,"
+                        " image_tag = :image_tag, image_digest = :image_digest, deployed_at = :deployed_at,"
+                        " deploy_info_mtime = :mtime WHERE app = :app",
+                        {**info, "mtime": info_mtime, "app": app},
+                    )
+                if known.get(app, (None, None))[1] != backup_mtime:
+                    config = _load_yaml(app_dir / "backup.yml") if backup_mtime else None
+                    self._db.execute(
+                        "UPDATE apps SET backup_config = ?, backup_mtime = ? WHERE app = ?",
+                        (json.dumps(config, default=str) if config is not None else None, backup_mtime, app),
+                    )
+                changed += 1
+        return changed
+
+    def app(self, app: str) -> dict | None:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM apps WHERE app = ?", (app,)).fetchone()
+        return _row(row) if row else None
+
+    def apps(self) -> list[dict]:
+        with self._lock:
+            return [_row(r) for r in self._db.execute("SELECT * FROM apps ORDER BY app")]
+
+    def backup_apps(self) -> list[dict]:
+        """Apps with a backup.yml, by name."""
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM apps WHERE backup_config IS NOT NULL ORDER BY app")
+            return [_row(r) for r in rows]
+
+    def fingerprints(self, app: str) -> dict[str, str]:
+        """item -> fingerprint recorded by app's last successful backup."""
+        with self._lock:
+            rows = self._db.execute("SELECT item, fingerprint FROM fingerprints WHERE app = ?", (app,))
+            return {r["item"]: r["fingerprint"] for r in rows}
+
+    def record_fingerprints(self, app: str, fingerprints: dict[str, str]) -> None:
+        """Replace app's fingerprints (call after a successful backup)."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM fingerprints WHERE app = ?", (app,))
+            self._db.executemany(
+                "INSERT INTO fingerprints (app, item, fingerprint) VALUES (?, ?, ?)",
+                [(app, item, fp) for item, fp in fingerprints.items()],
+            )
+
+    def record_backup(self, app: str, status: str, detail: str = "") -> None:
+        """Store the outcome of a backup run for app (status: ok, failed, skipped, unchanged)."""
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE apps SET last_backup_at = ?, last_backup_status = ?, last_backup_detail = ? WHERE app = ?",
+                (now, status, detail[:2000], app),
+            )
+
+
+def main() -> None:
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "sync":
+        state = DeployState()
+        print(f"{state.sync()} app(s) changed in {state.path}")
+        state.close()
+    elif command == "dump":
+        state = DeployState(read_only=True)
+        print(json.dumps(state.apps(), indent=1))
+        state.close()
+    else:
+        raise SystemExit("usage: python3 -m common.deploy_state sync|dump")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Image metadata cache keyed by manifest digest (configs are immutable per digest).
+
+One JSON file holds:
+  images: {digest: {created, labels, blobs}} — created timestamp, org.opencontainers.* labels,
+                                              {blob digest: size} referenced by the manifest
+  repos:  {repo: {tag: digest}}              — tag mapping recorded at the end of the last run
+
+Callers still resolve tag -> digest (one HEAD per tag); only digests not in `images`
+(new or re-pointed tags) need the manifest + config fetch. Digests no longer referenced
+by any repo mapping are dropped on save, so deletes done by the prune evict themselves.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+from pathlib import Path
+
+from .registry import RegistryClient
+
+LABEL_PREFIX = "org.opencontainers."
+CREATED_LABEL = "org.opencontainers.image.created"
+
+
+def config_from_labels(labels: dict[str, str]) -> dict:
+    """Minimal image config shape ({"config": {"Labels": ...}}) for label-based helpers."""
+    return {"config": {"Labels": dict(labels)}}
+
+
+class ImageCache:
+    """Thread-safe digest -> metadata cache persisted to a JSON file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        data = {}
+        if path.is_file():
+            try:
+                data = json.loads(path.read_text()) or {}
+            except (OSError, json.JSONDecodeError):
+                data = {}
+        self._images: dict[str, dict] = data.get("images") or {}
+        self._repos: dict[str, dict[str, str]] = data.get("repos") or {}
+
+    def previous_tags(self, repo: str) -> dict[str, str]:
+        """tag -> digest recorded for repo by the last run ({} if unknown)."""
+        with self._lock:
+            return dict(self._repos.get(repo) or {})
+
+    def lookup(self, digest: str) -> dict | None:
+        """Return {created, labels, blobs} for digest, counting the hit or miss.
+
+        Entries written before blob sizes were cached count as misses (refetched once).
+        """
+        with self._lock:
+            entry = self._images.get(digest)
+            if entry is None or "blobs" not in entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def put(self, digest: str, config: dict, blobs: dict[str, int]) -> dict:
+        """Store created + OCI labels from an image config, and blob sizes. Returns the entry."""
+        labels = config.get("config", {}).get("Labels", {}) or {}
+        entry = {
+            "created": labels.get(CREATED_LABEL, ""),
+            "labels": {k: v for k, v in labels.items() if k.startswith(LABEL_PREFIX)},
+            "blobs": dict(blobs),
+        }
+        with self._lock:
+            self._images[digest] = entry
+        return entry
+
+    def config(self, client: RegistryClient, repo: str, digest: str) -> dict:
+        """Image config for digest: from cache, else fetched via client and stored."""
+        entry = self.lookup(digest)
+        if entry is None:
+            entry = self.put(digest, *client.image_details(repo, digest))
+        return config_from_labels(entry["labels"])
+
+    def blobs(self, digest: str) -> dict[str, int]:
+        """{blob digest: size} cached for digest ({} if unknown). Does not count or fetch."""
+        with self._lock:
+            return dict((self._images.get(digest) or {}).get("blobs") or {})
+
+    def repos(self) -> list[str]:
+        """Repos with a recorded tag mapping."""
+        with self._lock:
+            return sorted(self._repos)
+
+    def tag_images(self, repo: str) -> dict[str, dict]:
+        """tag -> {digest, created, labels} for repo's recorded tags. Does not count or fetch."""
+        with self._lock:
+            return {
+                tag: {
+                    "digest": digest,
+                    "created": (self._images.get(digest) or {}).get("created", ""),
+                    "labels": dict((self._images.get(digest) or {}).get("labels") or {}),
+                }
+                for tag, digest in (self._repos.get(repo) or {}).items()
+            }
+
+    def record_tags(self, repo: str, tags: dict[str, str]) -> None:
+        """Replace repo's tag -> digest mapping (call with the tags that still exist)."""
+        with self._lock:
+            if tags:
+                self._repos[repo] = dict(tags)
+            else:
+                self._repos.pop(repo, None)
+
+    def retain_repos(self, repos: set[str]) -> None:
+        """Forget mappings for repos no longer in the registry."""
+        with self._lock:
+            for repo in set(self._repos) - repos:
+                del self._repos[repo]
+
+    def save(self) -> int:
+        """Evict unreferenced digests and write the file atomically. Returns evicted count."""
+        with self._lock:
+            referenced = {d for tags in self._repos.values() for d in tags.values()}
+            evicted = [d for d in self._images if d not in referenced]
+            for d in evicted:
+                del self._images[d]
+            data = {"images": self._images, "repos": self._repos}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            tmp.write_text(json.dumps(data, indent=1, sort_keys=True))
+            os.replace(tmp, self.path)
+        return len(evicted)
@@ -0,0 +1,312 @@
+"""
+Registry client: Distribution v2 API over pooled keep-alive HTTPS connections.
+
+Replaces crane subprocesses (one fork + TLS handshake + auth per call). Stdlib only, so
+the Prefect worker and scripts/ in the devcontainer can both import it.
+
+Credentials: basic auth from $DOCKER_CONFIG/config.json (default ~/.docker/config.json),
+the same file crane and docker use. Traefik does the auth; the registry itself accepts all.
+
+One client is shared by all threads of a run: max_in_flight caps concurrent requests and
+max_rps spaces request starts, so parallel callers cannot flood the single-node registry.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import http.client
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections.abc import Callable, Iterator
+from pathlib import Path
+
+INDEX_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+)
+MANIFEST_TYPES = (
+    *INDEX_TYPES,
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+)
+# Same default as crane when a tag points at a multi-platform index.
+DEFAULT_PLATFORM = ("linux", "amd64")
+
+_LINK_RE = re.compile(r"<([^>]+)>")
+
+
+class RegistryError(RuntimeError):
+    """Registry request failed (HTTP error status or connection error)."""
+
+
+def _registry_host(registry_url: str) -> tuple[str, bool]:
+    """Return (host[:port], use_tls) for registry.example.com or http(s)://... forms."""
+    url = registry_url.strip().rstrip("/")
+    if url.startswith("http://"):
+        return url.removeprefix("http://"), False
+    return url.removeprefix("https://"), True
+
+
+def load_basic_auth(host: str) -> str | None:
+    """Return 'Basic ...' header value for host from docker config.json, or None."""
+    config_dir = os.environ.get("DOCKER_CONFIG") or str(Path.home() / ".docker")
+    config_path = Path(config_dir) / "config.json"
+    if not config_path.is_file():
+        return None
+    try:
+        auths = json.loads(config_path.read_text()).get("auths") or {}
+    except (OSError, json.JSONDecodeError):
+        return None
+    for key, entry in auths.items():
+        key_host = key.removeprefix("https://").removeprefix("http://").split("/")[0]
+        if key_host != host:
+            continue
+        if entry.get("auth"):
+            return f"Basic {entry['auth']}"
+        if entry.get("username") and entry.get("password"):
+            raw = f"{entry['username']}:{entry['password']}".encode()
+            return f"Basic {base64.b64encode(raw).decode()}"
+    return None
+
+
+def image_details_from(
+    manifest: dict,
+    load_manifest: Callable[[str], dict],
+    load_json_blob: Callable[[str], dict],
+) -> tuple[dict, dict[str, int]]:
+    """Return (config JSON, {blob digest: size}) for a manifest or index.
+
+    Blobs are what the manifest keeps alive in storage: config and layers, and for an
+    index every child manifest plus its config and layers. Sizes come from the
+    descriptors, so no blob is downloaded except the DEFAULT_PLATFORM config.
+    """
+    manifests = [manifest]
+    chosen: dict | None = manifest
+    blobs: dict[str, int] = {}
+    if manifest.get("mediaType") in INDEX_TYPES or "manifests" in manifest:
+        manifests = []
+        chosen = None
+        for child in manifest.get("manifests") or []:
+            blobs[child["digest"]] = int(child.get("size") or 0)
+            child_data = load_manifest(child["digest"])
+            manifests.append(child_data)
+            platform = child.get("platform") or {}
+            if chosen is None and (platform.get("os"), platform.get("architecture")) == DEFAULT_PLATFORM:
+                chosen = child_data
+        if chosen is None and manifests:
+            chosen = manifests[0]
+    for m in manifests:
+        for desc in [m.get("config") or {}, *(m.get("layers") or [])]:
+            if desc.get("digest"):
+                blobs[desc["digest"]] = int(desc.get("size") or 0)
+    config_digest = ((chosen or {}).get("config") or {}).get("digest")
+    config = load_json_blob(config_digest) if config_digest else {}
+    return config, blobs
+
+
+class RegistryClient:
+    """Thread-safe Distribution v2 client. Idle connections are reused (up to max_in_flight)."""
+
+    def __init__(
+        self,
+        registry_url: str,
+        max_in_flight: int = 8,
+        max_rps: float = 0,
+        timeout: float = 120,
+    ):
+        self.host, self._tls = _registry_host(registry_url)
+        self._timeout = timeout
+        self._pool_size = max(1, max_in_flight)
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._auth = load_basic_auth(self.host)
+        self._in_flight = threading.BoundedSemaphore(self._pool_size)
+        self._min_interval = 1 / max_rps if max_rps > 0 else 0.0
+        self._rate_lock = threading.Lock()
+        self._next_start = 0.0
+
+    # --------------------------------------------------------
+    # Connection pool
+    # --------------------------------------------------------
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._tls:
+            return http.client.HTTPSConnection(self.host, timeout=self._timeout)
+        return http.client.HTTPConnection(self.host, timeout=self._timeout)
+
+    def _acquire(self) -> tuple[http.client.HTTPConnection, bool]:
+        """Return (connection, reused)."""
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _release(self, conn: http.client.HTTPConnection) -> None:
+        if self._idle.qsize() < self._pool_size:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def _throttle(self) -> None:
+        """Space request starts by 1/max_rps (no-op when unlimited)."""
+        if not self._min_interval:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._min_interval
+        if start > now:
+            time.sleep(start - now)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def request(
+        self, method: str, path: str, headers: dict[str, str] | None = None
+    ) -> tuple[int, http.client.HTTPMessage, bytes]:
+        """Send one request; returns (status, headers, body). Raises RegistryError on 4xx/5xx."""
+        hdrs = dict(headers or {})
+        if self._auth:
+            hdrs["Authorization"] = self._auth
+        with self._in_flight:
+            self._throttle()
+            return self._send(method, path, hdrs)
+
+    def _send(
+        self, method: str, path: str, hdrs: dict[str, str]
+    ) -> tuple[int, http.client.HTTPMessage, bytes]:
+        retried = False
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, path, headers=hdrs)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if reused:
+                    # Idle keep-alive connection closed by the server; retry on a fresh one.
+                    retried = True
+                    continue
+                raise RegistryError(f"{method} {self.host}{path} failed: {e}") from e
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if retried and method == "DELETE" and resp.status == 404:
+                # The first attempt may have deleted it before its response was lost.
+                return resp.status, resp.headers, body
+            if resp.status >= 400:
+                msg = body.decode(errors="replace").strip()[:300] or resp.reason
+                raise RegistryError(f"{method} {self.host}{path}: HTTP {resp.status}: {msg}")
+            return resp.status, resp.headers, body
+
+    def _get_json(self, path: str, headers: dict[str, str] | None = None) -> tuple[dict, http.client.HTTPMessage]:
+        _, resp_headers, body = self.request("GET", path, headers)
+        try:
+            return (json.loads(body) if body.strip() else {}), resp_headers
+        except json.JSONDecodeError as e:
+            raise RegistryError(f"GET {self.host}{path}: invalid JSON: {e}") from e
+
+    def _paginate(self, path: str, key: str, page_size: int) -> Iterator[str]:
+        """Yield `key` items page by page, following Link: <...>; rel="next" (n/last protocol).
+
+        The next page is only requested once the caller has consumed the current one.
+        """
+        next_path: str | None = f"{path}?n={page_size}"
+        while next_path:
+            data, headers = self._get_json(next_path)
+            yield from data.get(key) or []
+            match = _LINK_RE.search(headers.get("Link") or "")
+            next_path = match.group(1) if match else None
+
+    # --------------------------------------------------------
+    # Distribution API
+    # --------------------------------------------------------
+
+    def iter_catalog(self, page_size: int = 100) -> Iterator[str]:
+        """Yield repo names, fetching the catalog one page at a time."""
+        return self._paginate("/v2/_catalog", "repositories", page_size)
+
+    def iter_tags(self, repo: str, page_size: int = 100) -> Iterator[str]:
+        """Yield tags for repo, fetching one page at a time."""
+        return self._paginate(f"/v2/{repo}/tags/list", "tags", page_size)
+
+    def catalog(self) -> list[str]:
+        """List all repos in the registry."""
+        return list(self.iter_catalog())
+
+    def tags(self, repo: str) -> list[str]:
+        """List tags for repo."""
+        return list(self.iter_tags(repo))
+
+    def digest(self, repo: str, ref: str) -> str:
+        """Return manifest digest (sha256:...) for tag or digest via a single HEAD request."""
+        path = f"/v2/{repo}/manifests/{ref}"
+        _, headers, _ = self.request("HEAD", path, {"Accept": ", ".join(MANIFEST_TYPES)})
+        digest = (headers.get("Docker-Content-Digest") or "").strip()
+        if digest:
+            return digest
+        _, _, body = self.request("GET", path, {"Accept": ", ".join(MANIFEST_TYPES)})
+        return f"sha256:{hashlib.sha256(body).hexdigest()}"
+
+    def manifest(self, repo: str, ref: str) -> tuple[dict, str]:
+        """Return (manifest JSON, digest) for tag or digest."""
+        path = f"/v2/{repo}/manifests/{ref}"
+        _, headers, body = self.request("GET", path, {"Accept": ", ".join(MANIFEST_TYPES)})
+        digest = (headers.get("Docker-Content-Digest") or "").strip()
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError as e:
+            raise RegistryError(f"GET {self.host}{path}: invalid manifest JSON: {e}") from e
+        if not data.get("mediaType"):
+            data["mediaType"] = (headers.get("Content-Type") or "").split(";")[0].strip()
+        return data, digest or f"sha256:{hashlib.sha256(body).hexdigest()}"
+
+    def image_manifest(self, repo: str, ref: str) -> dict:
+        """Return the single-platform image manifest for ref (resolves indexes to DEFAULT_PLATFORM)."""
+        data, _ = self.manifest(repo, ref)
+        if data.get("mediaType") not in INDEX_TYPES:
+            return data
+        children = data.get("manifests") or []
+        if not children:
+            return {}
+        chosen = children[0]
+        for child in children:
+            platform = child.get("platform") or {}
+            if (platform.get("os"), platform.get("architecture")) == DEFAULT_PLATFORM:
+                chosen = child
+                break
+        child_data, _ = self.manifest(repo, chosen["digest"])
+        return child_data
+
+    def blob_json(self, repo: str, digest: str) -> dict:
+        """GET a JSON blob (e.g. image config) by digest."""
+        data, _ = self._get_json(f"/v2/{repo}/blobs/{digest}")
+        return data
+
+    def config(self, repo: str, ref: str) -> dict:
+        """Return image config JSON for tag or digest ({} if the manifest has no config)."""
+        config_digest = (self.image_manifest(repo, ref).get("config") or {}).get("digest")
+        if not config_digest:
+            return {}
+        return self.blob_json(repo, config_digest)
+
+    def image_details(self, repo: str, ref: str) -> tuple[dict, dict[str, int]]:
+        """Return (config JSON, {blob digest: size}) for tag or digest. See image_details_from."""
+        data, _ = self.manifest(repo, ref)
+        return image_details_from(
+            data, lambda d: self.manifest(repo, d)[0], lambda d: self.blob_json(repo, d)
+        )
+
+    def delete(self, repo: str, digest: str) -> None:
+        """Delete manifest by digest (registry needs storage.delete.enabled)."""
+        self.request("DELETE", f"/v2/{repo}/manifests/{digest}")
@@ -0,0 +1,106 @@
+"""
+Read-only scanner for the registry's filesystem storage (distribution layout).
+
+The prune worker runs on the registry host; with the storage root mounted read-only it
+can read repos, tags, manifests and configs from disk instead of over HTTP via Traefik:
+
+  docker/registry/v2/repositories/<repo>/_manifests/tags/<tag>/current/link  -> sha256:...
+  docker/registry/v2/blobs/sha256/<hh>/<hex>/data                            -> blob content
+
+One directory walk builds repo -> tag -> digest; manifests and configs are read from
+blob files on demand. Same read methods as RegistryClient, so it is a drop-in source;
+delete() is forwarded to the API client (the registry must own writes).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from collections.abc import Iterator
+from pathlib import Path
+
+from .registry import RegistryClient, RegistryError, image_details_from
+
+_V2 = Path("docker") / "registry" / "v2"
+
+
+class RegistryStorage:
+    """Registry reads from the storage root; deletes through `api`."""
+
+    def __init__(self, root: Path, api: RegistryClient):
+        self.root = root
+        self.host = api.host
+        self._api = api
+        self._repos = self._scan()
+
+    def _scan(self) -> dict[str, dict[str, str]]:
+        """Walk repositories/ once: {repo: {tag: digest}}."""
+        repos_dir = self.root / _V2 / "repositories"
+        if not repos_dir.is_dir():
+            raise RegistryError(f"registry storage not found: {repos_dir}")
+        repos: dict[str, dict[str, str]] = {}
+        for dirpath, dirnames, _ in os.walk(repos_dir):
+            is_repo = "_manifests" in dirnames
+            # Nested repos (a/b) sit next to _manifests/_layers/_uploads; never descend into those.
+            dirnames[:] = [d for d in dirnames if not d.startswith("_")]
+            if not is_repo:
+                continue
+            repo = Path(dirpath).relative_to(repos_dir).as_posix()
+            tags: dict[str, str] = {}
+            tags_dir = Path(dirpath) / "_manifests" / "tags"
+            if tags_dir.is_dir():
+                for tag_dir in tags_dir.iterdir():
+                    link = tag_dir / "current" / "link"
+                    if link.is_file():
+                        tags[tag_dir.name] = link.read_text().strip()
+            repos[repo] = tags
+        return repos
+
+    def _blob(self, digest: str) -> bytes:
+        algo, _, hexdigest = digest.partition(":")
+        path = self.root / _V2 / "blobs" / algo / hexdigest[:2] / hexdigest / "data"
+        try:
+            return path.read_bytes()
+        except OSError as e:
+            raise RegistryError(f"blob {digest} not readable in storage: {e}") from e
+
+    def _json_blob(self, digest: str) -> dict:
+        try:
+            return json.loads(self._blob(digest))
+        except json.JSONDecodeError as e:
+            raise RegistryError(f"blob {digest}: invalid JSON: {e}") from e
+
+    def close(self) -> None:
+        self._api.close()
+
+    def iter_catalog(self, page_size: int = 100) -> Iterator[str]:
+        return iter(sorted(self._repos))
+
+    def iter_tags(self, repo: str, page_size: int = 100) -> Iterator[str]:
+        return iter(sorted(self._repos.get(repo) or {}))
+
+    def catalog(self) -> list[str]:
+        return sorted(self._repos)
+
+    def tags(self, repo: str) -> list[str]:
+        return sorted(self._repos.get(repo) or {})
+
+    def digest(self, repo: str, ref: str) -> str:
+        if ref.startswith("sha256:"):
+            return ref
+        digest = (self._repos.get(repo) or {}).get(ref)
+        if not digest:
+            raise RegistryError(f"{repo}:{ref}: tag not found in storage")
+        return digest
+
+    def image_details(self, repo: str, ref: str) -> tuple[dict, dict[str, int]]:
+        """Same result as RegistryClient.image_details, read from blob files."""
+        manifest = self._json_blob(self.digest(repo, ref))
+        return image_details_from(manifest, self._json_blob, self._json_blob)
+
+    def config(self, repo: str, ref: str) -> dict:
+        return self.image_details(repo, ref)[0]
+
+    def delete(self, repo: str, digest: str) -> None:
+        """Deletes stay on the API (registry bookkeeping + storage.delete.enabled)."""
+        self._api.delete(repo, digest)
@@ -0,0 +1,77 @@
+"""
+Per-repo version index: the tag list `task app:versions` prints, without registry calls.
+
+The registry prune flow writes one small JSON file per repo after each run (from the
+image cache it already filled), world-readable so the deploy user can `cat` it over SSH:
+
+  <root>/<repo>.json  {"repo", "generated_at", "tags": [{tag, digest, created, description}]}
+
+Tags are ordered newest first. Stale until the next prune run (nightly); callers can
+fall back to live registry queries.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from .image_cache import CREATED_LABEL, ImageCache
+
+DESCRIPTION_LABEL = "org.opencontainers.image.description"
+
+
+def index_path(root: Path, repo: str) -> Path:
+    return root / f"{repo}.json"
+
+
+def build_index(repo: str, images: dict[str, dict]) -> dict:
+    """Index document for repo from {tag: {digest, created, labels}} (ImageCache.tag_images)."""
+    tags = [
+        {
+            "tag": tag,
+            "digest": entry["digest"],
+            "created": entry.get("created") or entry["labels"].get(CREATED_LABEL, ""),
+            "description": entry["labels"].get(DESCRIPTION_LABEL, ""),
+        }
+        for tag, entry in images.items()
+    ]
+    # Newest first; undated tags last.
+    tags.sort(key=lambda t: (bool(t["created"]), t["created"], t["tag"]), reverse=True)
+    return {
+        "repo": repo,
+        "generated_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "tags": tags,
+    }
+
+
+def write_indexes(root: Path, cache: ImageCache) -> int:
+    """Write one index per repo in cache (0644, atomic) and remove indexes of gone repos.
+
+    Returns the number of repos written.
+    """
+    written: set[Path] = set()
+    for repo in cache.repos():
+        path = index_path(root, repo)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(path.parent, 0o755)
+        tmp = path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(build_index(repo, cache.tag_images(repo)), indent=1))
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+        written.add(path)
+    if root.is_dir():
+        for path in root.rglob("*.json"):
+            if path not in written:
+                path.unlink()
+    return len(written)
+
+
+def parse_index(text: str) -> dict | None:
+    """Parse an index document (e.g. read over SSH); None if empty or invalid."""
+    try:
+        data = json.loads(text) if text.strip() else None
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) and isinstance(data.get("tags"), list) else None
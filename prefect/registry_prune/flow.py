@@ -1,25 +1,76 @@
 """
-Registry prune flow: list all repos (crane catalog), prune each to 6 tags,
+Registry prune flow: list all repos (registry catalog), prune each to 6 tags,
 protect deployed tag per repo, then run registry garbage-collect.
 
+Each repo is planned (tags to delete) and then applied. plan_only=True writes the plan
+with deduplicated reclaimable bytes per repo to PLAN_PATH and deletes nothing; a later
+run with plan_path=... applies that plan (re-checking digests and the deployed tag).
+
+Garbage-collect (mark and sweep, blocks the registry) only runs when the deduplicated
+estimate of orphaned bytes, this run's plus those of earlier runs that skipped GC (kept in
+GC_HISTORY_PATH), reaches REGISTRY_GC_MIN_BYTES (gc="always"/"never" override;
+delete_untagged adds --delete-untagged and runs GC unless gc="never"). Duration and
+bytes freed are logged as MEASURE lines and appended to GC_HISTORY_PATH.
+
+budget_bytes switches retention from KEEP newest per repo to a registry-wide byte budget:
+non-protected tags beyond each repo's minimum are dropped oldest first until the
+deduplicated size of what remains fits.
+
+Registry access goes through common.registry (Distribution v2 API, pooled connections).
+With REGISTRY_STORAGE_ROOT set (registry storage mounted read-only), reads come from disk
+via common.registry_storage instead; deletes always go through the API.
+Image configs are cached per digest in IMAGE_CACHE_PATH, so only new or re-pointed
+tags need a config fetch. After each run the cache is published as a per-repo version
+index (VERSION_INDEX_ROOT) for `task app:versions`.
 REGISTRY_URL and DOCKER_CONFIG from env (Ansible).
 """
 
 from __future__ import annotations
 
+import io
 import json
 import os
 import subprocess
 import sys
-from io import StringIO
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from pathlib import Path
 
-import yaml
 from prefect import flow
 from prefect.logging import get_run_logger
 
-DEPLOY_ROOT = Path("/opt/iac/deploy")
+from common.deploy_state import DeployState
+from common.image_cache import ImageCache
+from common.registry import RegistryClient, RegistryError
+from common.registry_storage import RegistryStorage
+from common.version_index import write_indexes
+
+IMAGE_CACHE_PATH = Path("/opt/iac/prefect/registry-cache.json")
+PLAN_PATH = Path("/opt/iac/prefect/registry-prune-plan.json")
+# Per-repo tag index for `task app:versions` (read over SSH), see common/version_index.py.
+VERSION_INDEX_ROOT = Path("/opt/iac/prefect/version-index")
 KEEP = 6
+# Tuning from env (Ansible). Repos and per-repo tag fetches run in parallel, but every
+# registry request shares one budget: at most MAX_IN_FLIGHT concurrent, MAX_RPS per second (0 = off).
+FETCH_WORKERS = int(os.environ.get("REGISTRY_FETCH_WORKERS") or 8)
+REPO_WORKERS = int(os.environ.get("REGISTRY_REPO_WORKERS") or 4)
+MAX_IN_FLIGHT = int(os.environ.get("REGISTRY_MAX_IN_FLIGHT") or 8)
+MAX_RPS = float(os.environ.get("REGISTRY_MAX_RPS") or 0)
+# Catalog/tag list page size (n/last pagination); pruning starts after the first page.
+PAGE_SIZE = int(os.environ.get("REGISTRY_PAGE_SIZE") or 100)
+# Optional: registry storage root mounted read-only in the worker. When set, repos, tags,
+# digests and configs are read from disk in one walk; deletes still go through the API.
+STORAGE_ROOT = os.environ.get("REGISTRY_STORAGE_ROOT") or ""
+# gc="auto" only runs garbage-collect when the estimated orphaned bytes reach this.
+GC_MIN_BYTES = int(os.environ.get("REGISTRY_GC_MIN_BYTES") or 0)
+GC_HISTORY_PATH = Path("/opt/iac/prefect/registry-gc.jsonl")
+GC_MODES = ("auto", "always", "never")
+# Output lines kept for the error message when the run fails.
+LOG_TAIL_LINES = 50
 
 OCI_LABEL_KEYS = (
     "org.opencontainers.image.description",
@@ -29,72 +80,6 @@ OCI_LABEL_KEYS = (
 )
 
 
-def _crane_run(args: list[str]) -> subprocess.CompletedProcess:
-    """Run crane binary (worker has it; DOCKER_CONFIG is set for registry auth)."""
-    return subprocess.run(
-        ["crane", *args],
-        capture_output=True,
-        text=True,
-        timeout=120,
-        env=os.environ,
-    )
-
-
-def _crane_fail(cmd: str, result: subprocess.CompletedProcess) -> None:
-    """Raise on crane failure so the flow run fails (proper visibility in UI)."""
-    msg = (result.stderr or result.stdout or "").strip() or "(no output)"
-    raise RuntimeError(f"crane {cmd} failed (exit {result.returncode}): {msg}")
-
-
-def crane_catalog(registry_url: str) -> list[str]:
-    """List all repos in the registry (crane catalog). Raises on failure."""
-    result = _crane_run(["catalog", registry_url])
-    if result.returncode != 0:
-        _crane_fail(f"catalog {registry_url}", result)
-    return [r.strip() for r in result.stdout.strip().splitlines() if r.strip()]
-
-
-def crane_ls(registry_url: str, repo: str) -> list[str]:
-    """List tags for registry/repo. Raises on failure (auth, network, etc.)."""
-    ref = f"{registry_url}/{repo}"
-    result = _crane_run(["ls", ref])
-    if result.returncode != 0:
-        _crane_fail(f"ls {ref}", result)
-    return [t.strip() for t in result.stdout.strip().splitlines() if t.strip()]
-
-
-def crane_config(ref: str) -> dict:
-    """Get image config JSON for ref. Raises on failure."""
-    result = _crane_run(["config", ref])
-    if result.returncode != 0:
-        _crane_fail(f"config {ref}", result)
-    if not result.stdout.strip():
-        return {}
-    try:
-        return json.loads(result.stdout)
-    except json.JSONDecodeError:
-        return {}
-
-
-def crane_digest(ref: str) -> str:
-    """Return digest for ref (e.g. sha256:...). Raises on failure."""
-    result = _crane_run(["digest", ref])
-    if result.returncode != 0:
-        _crane_fail(f"digest {ref}", result)
-    if not result.stdout.strip():
-        raise RuntimeError(f"crane digest {ref}: no output")
-    d = result.stdout.strip()
-    return d if d.startswith("sha256:") else f"sha256:{d}"
-
-
-def crane_delete(repo_at_digest: str) -> bool:
-    """Delete manifest by repo@digest. Raises on failure."""
-    result = _crane_run(["delete", repo_at_digest])
-    if result.returncode != 0:
-        _crane_fail(f"delete {repo_at_digest}", result)
-    return True
-
-
 def get_created_ts(config: dict) -> str:
     """Extract org.opencontainers.image.created from config Labels."""
     labels = config.get("config", {}).get("Labels", {}) or {}
@@ -108,25 +93,21 @@ def get_oci_labels(config: dict) -> dict[str, str]:
     return {k: (labels.get(k) or "") for k in OCI_LABEL_KEYS}
 
 
-def get_protected_tag_and_digest(registry_url: str, repo: str) -> tuple[str | None, str | None]:
-    """If deploy-info.yml exists for this repo's app, return (tag, digest) to protect. Else (None, None)."""
-    app_slug = repo.split("/")[-1]
-    deploy_info = DEPLOY_ROOT / app_slug / "deploy-info.yml"
-    if not deploy_info.exists():
+def get_protected_tag_and_digest(deploy_state: DeployState, repo: str) -> tuple[str | None, str | None]:
+    """If this repo's app is deployed (deploy state index), return (tag, digest) to protect. Else (None, None)."""
+    app = deploy_state.app(repo.split("/")[-1])
+    if not app or not app["image_digest"]:
         return None, None
-    data = yaml.safe_load(deploy_info.read_text()) or {}
-    image = data.get("image") or {}
-    tag = image.get("tag")
-    digest = image.get("digest")
-    if digest and not digest.startswith("sha256:"):
-        digest = f"sha256:{digest}"
-    return tag, digest
+    return app["image_tag"] or None, app["image_digest"]
 
 
-def registry_garbage_collect() -> None:
+def registry_garbage_collect(delete_untagged: bool = False) -> None:
     """Run docker exec registry registry garbage-collect. Raises on failure."""
+    cmd = ["docker", "exec", "registry", "registry", "garbage-collect"]
+    if delete_untagged:
+        cmd.append("--delete-untagged")
     result = subprocess.run(
-        ["docker", "exec", "registry", "registry", "garbage-collect", "/etc/distribution/config.yml"],
+        [*cmd, "/etc/distribution/config.yml"],
         capture_output=True,
         text=True,
         timeout=300,
@@ -136,15 +117,106 @@ def registry_garbage_collect() -> None:
         raise RuntimeError(f"registry garbage-collect failed (exit {result.returncode}): {msg}")
 
 
-def _build_tagged(full_repo: str, tags: list[str]) -> list[tuple[str, str, str, dict]]:
-    """List (tag, created_ts, digest, config) for each tag, sorted by created descending."""
-    tagged = []
-    for tag in tags:
-        ref = f"{full_repo}:{tag}"
-        cfg = crane_config(ref)
-        created = get_created_ts(cfg)
-        digest = crane_digest(ref)
-        tagged.append((tag, created, digest, cfg))
+def _registry_disk_usage() -> int | None:
+    """Bytes used by registry storage (du in the registry container), None if unavailable."""
+    try:
+        result = subprocess.run(
+            ["docker", "exec", "registry", "du", "-sk", "/var/lib/registry"],
+            capture_output=True,
+            text=True,
+            timeout=300,
+        )
+        return int(result.stdout.split()[0]) * 1024 if result.returncode == 0 else None
+    except (subprocess.TimeoutExpired, IndexError, ValueError):
+        return None
+
+
+def _measured_gc(estimated_bytes: int, delete_untagged: bool) -> None:
+    """Run GC; log duration and bytes freed (du before/after) and append them to GC_HISTORY_PATH."""
+    before = _registry_disk_usage()
+    started = time.monotonic()
+    registry_garbage_collect(delete_untagged)
+    duration = time.monotonic() - started
+    after = _registry_disk_usage()
+    # Pushes during GC also change du, so freed is approximate.
+    freed = before - after if before is not None and after is not None else None
+    print(
+        f"MEASURE: step=registry_gc duration_s={duration:.1f} estimated_bytes={estimated_bytes} "
+        f"freed_bytes={freed if freed is not None else 'unknown'} "
+        f"delete_untagged={str(delete_untagged).lower()}"
+    )
+    freed_text = _format_bytes(freed) if freed is not None else "unknown"
+    print(f"Registry garbage-collect completed in {duration:.1f}s, freed {freed_text}")
+    _record_gc({
+        "duration_s": round(duration, 1),
+        "estimated_bytes": estimated_bytes,
+        "freed_bytes": freed,
+        "bytes_after": after,
+        "delete_untagged": delete_untagged,
+    })
+
+
+def _record_gc(record: dict) -> None:
+    """Append a GC run (or a skipped one, "skipped": true) to GC_HISTORY_PATH."""
+    record = {"at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"), **record}
+    try:
+        GC_HISTORY_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with GC_HISTORY_PATH.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"Could not record GC metrics in {GC_HISTORY_PATH}: {e}", file=sys.stderr)
+
+
+def _pending_orphans() -> int:
+    """Estimated orphaned bytes left by runs that skipped GC since the last one.
+
+    Sum of the skipped records' estimates after the last GC record in GC_HISTORY_PATH.
+    Upper bound: a layer pushed again before GC is still counted.
+    """
+    try:
+        lines = GC_HISTORY_PATH.read_text().splitlines()
+    except OSError:
+        return 0
+    pending = 0
+    for line in reversed(lines):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if not record.get("skipped"):
+            break
+        pending += int(record.get("estimated_bytes") or 0)
+    return pending
+
+
+def _fetch_tag(
+    client: RegistryClient, cache: ImageCache, repo: str, tag: str
+) -> tuple[str, str, str, dict]:
+    """Return (tag, created_ts, digest, config) for one tag. Raises on registry failure."""
+    digest = client.digest(repo, tag)
+    cfg = cache.config(client, repo, digest)
+    return tag, get_created_ts(cfg), digest, cfg
+
+
+def _build_tagged(
+    client: RegistryClient,
+    cache: ImageCache,
+    repo: str,
+    tags: Iterable[str],
+    workers: int = FETCH_WORKERS,
+) -> list[tuple[str, str, str, dict]]:
+    """List (tag, created_ts, digest, config) for each tag, sorted by created descending.
+
+    Tags may be a paginated generator: each tag is submitted as soon as its page arrives,
+    up to `workers` fetching concurrently. Results keep input order before the (stable)
+    sort, so ordering matches a sequential fetch. First registry error is raised.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = [executor.submit(_fetch_tag, client, cache, repo, tag) for tag in tags]
+        tagged = [f.result() for f in futures]
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
     tagged.sort(key=lambda x: (x[1] or ""), reverse=True)
     return tagged
 
@@ -172,101 +244,526 @@ def _compute_kept_and_deleted(
     return to_keep_tags, to_delete
 
 
-def _prune_repo(registry_url: str, repo: str, keep: int) -> int:
-    """Prune one repo: log removed-tag snapshot, delete tags. Returns number deleted."""
-    protected_tag, protected_digest = get_protected_tag_and_digest(registry_url, repo)
-    full_repo = f"{registry_url}/{repo}"
-    tags = crane_ls(registry_url, repo)
-    if not tags:
+def _format_bytes(n: float) -> str:
+    if n < 1024:
+        return f"{int(n)} B"
+    for unit in ("KiB", "MiB"):
+        n /= 1024
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+    return f"{n / 1024:.1f} GiB"
+
+
+def _plan_repo(
+    client: RegistryClient, cache: ImageCache, deploy_state: DeployState, repo: str, keep: int
+) -> dict:
+    """Fetch tag metadata and decide deletions for one repo. Returns the repo's plan entry:
+    {"tags": {tag: digest}, "protected": tag, "delete": [{"tag", "digest", "created", "labels"}]}.
+    """
+    protected_tag, protected_digest = get_protected_tag_and_digest(deploy_state, repo)
+    previous = cache.previous_tags(repo)
+    started = time.monotonic()
+    tagged = _build_tagged(client, cache, repo, client.iter_tags(repo, PAGE_SIZE))
+    plan = {"tags": {t: d for t, _, d, _ in tagged}, "protected": protected_tag, "delete": []}
+    if not tagged:
         print(f"{repo}: no tags found, skipping")
-        return 0
+        return plan
 
+    tags = [t for t, _, _, _ in tagged]
     print(f"{repo}: {len(tags)} tags, keep={keep}, protected={protected_tag or '(none)'}")
-    tagged = _build_tagged(full_repo, tags)
+    changed = sum(1 for t, _, d, _ in tagged if previous.get(t) != d)
+    print(
+        f"{repo}: fetched metadata for {len(tags)} tag(s) in {time.monotonic() - started:.1f}s "
+        f"(workers={FETCH_WORKERS}, new or re-pointed={changed})"
+    )
     _, to_delete = _compute_kept_and_deleted(
         tagged, tags, keep, protected_tag, protected_digest
     )
-
-    if to_delete:
-        print(f"{repo}: deleting {len(to_delete)} tag(s): {', '.join(to_delete)}")
     tag_to_cfg = {t: cfg for t, _, _, cfg in tagged}
+    plan["delete"] = [
+        {
+            "tag": t,
+            "digest": plan["tags"][t],
+            "created": get_created_ts(tag_to_cfg.get(t) or {}),
+            "labels": get_oci_labels(tag_to_cfg.get(t) or {}),
+        }
+        for t in sorted(to_delete)
+    ]
+    return plan
+
+
+def _apply_repo(
+    client: RegistryClient,
+    cache: ImageCache,
+    deploy_state: DeployState,
+    repo: str,
+    plan: dict,
+    verify: bool = False,
+) -> int:
+    """Delete a repo's planned tags: log removed-tag snapshot, delete by digest. Returns number deleted.
+
+    verify=True (plan from an earlier run): skip tags now deployed or re-pointed since planning.
+    """
+    entries = plan.get("delete") or []
+    if entries:
+        print(f"{repo}: deleting {len(entries)} tag(s): {', '.join(e['tag'] for e in entries)}")
+    protected_tag, protected_digest = (
+        get_protected_tag_and_digest(deploy_state, repo) if verify else (None, None)
+    )
     deleted_count = 0
-    for tag in sorted(to_delete):
-        oci = get_oci_labels(tag_to_cfg.get(tag) or {})
-        print(f"{repo} pruned snapshot (removed) tag={tag}")
+    deleted_digests: set[str] = set()
+    for entry in entries:
+        tag, digest = entry["tag"], entry["digest"]
+        if verify:
+            if tag == protected_tag or digest == protected_digest:
+                print(f"{repo}: {tag} is deployed now, not deleting")
+                continue
+            try:
+                current = client.digest(repo, tag)
+            except RegistryError:
+                current = None
+            if current != digest and digest not in deleted_digests:
+                print(f"{repo}: {tag} changed since plan ({current or 'gone'}), not deleting")
+                continue
+        # One write per tag so the block is not interleaved with other repos' output.
+        lines = [f"{repo} pruned snapshot (removed) tag={tag}"]
+        labels = entry.get("labels") or {}
         for key in OCI_LABEL_KEYS:
-            val = oci.get(key, "")
+            val = labels.get(key, "")
             if val:
                 short_key = key.removeprefix("org.opencontainers.image.")
-                print(f"  {short_key}={val}")
-        ref = f"{full_repo}:{tag}"
-        digest = crane_digest(ref)
-        if not digest:
-            continue
-        repo_at_digest = f"{full_repo}@{digest}"
-        if crane_delete(repo_at_digest):
-            deleted_count += 1
-        else:
-            print(f"Failed to delete {repo_at_digest}", file=sys.stderr)
+                lines.append(f"  {short_key}={val}")
+        sys.stdout.write("\n".join(lines) + "\n")
+        if digest not in deleted_digests:
+            # Tags sharing a manifest go with the first delete; a second DELETE would 404.
+            client.delete(repo, digest)
+            deleted_digests.add(digest)
+        deleted_count += 1
+    # A saved plan's tag map is as old as the plan: only drop what was deleted from the
+    # mapping the cache already has, instead of writing the plan's snapshot back.
+    tags = cache.previous_tags(repo) if verify else plan.get("tags") or {}
+    cache.record_tags(repo, {t: d for t, d in tags.items() if d not in deleted_digests})
     return deleted_count
 
 
-def _process_repos(registry_url: str, repos: list[tuple[str, int]]) -> int:
-    """Run prune for each (repo, keep). Returns total deleted count."""
-    deleted_count = 0
-    for repo, keep in repos:
-        deleted_count += _prune_repo(registry_url, repo, keep)
-    return deleted_count
+def _prune_repo(
+    client: RegistryClient, cache: ImageCache, deploy_state: DeployState, repo: str, keep: int, apply: bool
+) -> tuple[dict, int]:
+    """Plan one repo and, if apply, delete its tags. Returns (plan entry, number deleted).
 
+    After apply only a summary is kept (protected tag, deleted tag/digest pairs); the tags
+    left behind are in the cache, so held plans do not grow with the registry's tag count.
+    """
+    plan = _plan_repo(client, cache, deploy_state, repo, keep)
+    if not apply:
+        cache.record_tags(repo, plan["tags"])
+        return plan, 0
+    deleted = _apply_repo(client, cache, deploy_state, repo, plan)
+    summary = {
+        "protected": plan["protected"],
+        "delete": [{"tag": e["tag"], "digest": e["digest"]} for e in plan["delete"]],
+    }
+    return summary, deleted
+
+
+def _blob_accounting(plans: dict[str, dict], cache: ImageCache) -> tuple[dict[str, int], int, int]:
+    """Return ({repo: bytes reclaimed}, total bytes, blob count) for the plans' deletions.
+
+    Layers are shared across tags and repos and registry GC is registry-wide, so a blob
+    only counts if no remaining manifest in any planned repo references it. Each freed
+    blob is attributed once (first repo by name). Upper bound: untagged manifests and
+    repos that failed to plan are not seen. Applied summaries carry no "tags": their
+    remaining tags are read from the cache (recorded after the deletes).
+    """
+    remaining: set[str] = set()
+    freed: dict[str, tuple[int, str]] = {}
+    for repo in sorted(plans):
+        gone = {e["digest"] for e in plans[repo].get("delete") or []}
+        tags = plans[repo].get("tags")
+        if tags is None:
+            tags = cache.previous_tags(repo)
+        for digest in sorted(gone):
+            for blob, size in cache.blobs(digest).items():
+                freed.setdefault(blob, (size, repo))
+        for digest in set(tags.values()) - gone:
+            remaining.update(cache.blobs(digest))
+    per_repo = dict.fromkeys(plans, 0)
+    total = 0
+    count = 0
+    for blob, (size, repo) in freed.items():
+        if blob in remaining:
+            continue
+        per_repo[repo] += size
+        total += size
+        count += 1
+    return per_repo, total, count
+
+
+def _select_for_budget(plans: dict[str, dict], cache: ImageCache, budget_bytes: int) -> tuple[int, int]:
+    """Trim each plan's delete list to what a byte budget needs. Returns (bytes before, bytes after).
 
-def _run_prune() -> int:
+    Each plan's delete list holds the candidates (non-protected tags beyond the repo's
+    minimum). Candidates are dropped oldest first across all repos, tracking deduplicated
+    usage with per-blob reference counts, until usage fits the budget. A candidate whose
+    manifest is shared with a kept tag of the same repo is never selected.
+    """
+    refs: dict[str, int] = {}
+    sizes: dict[str, int] = {}
+    manifests: dict[tuple[str, str], dict[str, int]] = {}
+    for repo, plan in plans.items():
+        for digest in set((plan.get("tags") or {}).values()):
+            blobs = cache.blobs(digest)
+            manifests[(repo, digest)] = blobs
+            for blob, size in blobs.items():
+                refs[blob] = refs.get(blob, 0) + 1
+                sizes[blob] = size
+    before = sum(sizes.values())
+    usage = before
+
+    candidates = []
+    for repo, plan in plans.items():
+        candidate_tags = {e["tag"] for e in plan.get("delete") or []}
+        held = {d for t, d in (plan.get("tags") or {}).items() if t not in candidate_tags}
+        candidates.extend(
+            (e.get("created") or "", repo, e) for e in plan.get("delete") or [] if e["digest"] not in held
+        )
+        plan["delete"] = []
+    candidates.sort(key=lambda c: (c[0], c[1], c[2]["tag"]))
+
+    for _, repo, entry in candidates:
+        if usage <= budget_bytes:
+            break
+        plans[repo]["delete"].append(entry)
+        for blob in manifests.pop((repo, entry["digest"]), {}):
+            refs[blob] -= 1
+            if refs[blob] == 0:
+                usage -= sizes[blob]
+    for plan in plans.values():
+        plan["delete"].sort(key=lambda e: e["tag"])
+    return before, usage
+
+
+def _process_repos(
+    client: RegistryClient,
+    cache: ImageCache,
+    deploy_state: DeployState,
+    repos: Iterable[tuple[str, int]],
+    apply: bool = True,
+) -> tuple[dict[str, dict], int, dict[str, Exception]]:
+    """Prune repos concurrently (REPO_WORKERS). Returns ({repo: plan}, total deleted, {repo: error}).
+
+    `repos` may be a paginated generator: repos are submitted as pages arrive, with at most
+    2 * REPO_WORKERS queued. A failing repo does not stop the others; its error is collected
+    for the summary. apply=False only plans.
+    """
+    plans: dict[str, dict] = {}
+    deleted_count = 0
+    failures: dict[str, Exception] = {}
+    pending: dict[Future, str] = {}
+
+    def collect(done: set[Future]) -> None:
+        nonlocal deleted_count
+        for future in done:
+            repo = pending.pop(future)
+            try:
+                plans[repo], deleted = future.result()
+                deleted_count += deleted
+            except Exception as e:
+                print(f"{repo}: prune failed: {e}", file=sys.stderr)
+                failures[repo] = e
+
+    with ThreadPoolExecutor(max_workers=max(1, REPO_WORKERS)) as executor:
+        try:
+            for repo, keep in repos:
+                if len(pending) >= 2 * REPO_WORKERS:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(_prune_repo, client, cache, deploy_state, repo, keep, apply)
+                pending[future] = repo
+        except Exception as e:
+            # Catalog page failed: finish repos already submitted, report it with the rest.
+            print(f"catalog listing failed: {e}", file=sys.stderr)
+            failures["(catalog)"] = e
+        collect(wait(pending).done)
+    return plans, deleted_count, failures
+
+
+def _apply_plan(
+    client: RegistryClient, cache: ImageCache, deploy_state: DeployState, plan: dict, verify: bool = True
+) -> tuple[int, dict[str, Exception]]:
+    """Apply a plan concurrently (REPO_WORKERS). Returns (total deleted, {repo: error}).
+
+    verify=True for saved plans: see _apply_repo.
+    """
+    deleted_count = 0
+    failures: dict[str, Exception] = {}
+    repos = plan.get("repos") or {}
+    with ThreadPoolExecutor(max_workers=max(1, REPO_WORKERS)) as executor:
+        future_to_repo = {
+            executor.submit(_apply_repo, client, cache, deploy_state, repo, repo_plan, verify): repo
+            for repo, repo_plan in repos.items()
+            if repo_plan.get("delete")
+        }
+        for future, repo in future_to_repo.items():
+            try:
+                deleted_count += future.result()
+            except Exception as e:
+                print(f"{repo}: prune failed: {e}", file=sys.stderr)
+                failures[repo] = e
+    return deleted_count, failures
+
+
+def _build_plan(registry_url: str, plans: dict[str, dict], cache: ImageCache) -> dict:
+    """Machine-readable plan with deduplicated reclaimable bytes; prints them per repo."""
+    per_repo, total, blob_count = _blob_accounting(plans, cache)
+    plan = {
+        "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "registry": registry_url,
+        "keep": KEEP,
+        "bytes_reclaimed": total,
+        "blobs_reclaimed": blob_count,
+        "repos": {
+            repo: {**plans[repo], "bytes_reclaimed": per_repo[repo]} for repo in sorted(plans)
+        },
+    }
+    for repo in sorted(plans):
+        if plans[repo].get("delete"):
+            print(f"{repo}: {len(plans[repo]['delete'])} tag(s) to delete, frees {_format_bytes(per_repo[repo])}")
+    print(f"Reclaimable after GC: {blob_count} blob(s), {_format_bytes(total)}")
+    return plan
+
+
+def _report_failures(failures: dict[str, Exception]) -> int:
+    """Print the per-repo failure summary. Returns exit code."""
+    if not failures:
+        return 0
+    print(f"{len(failures)} repo(s) failed:", file=sys.stderr)
+    for repo, err in sorted(failures.items()):
+        print(f"  {repo}: {err}", file=sys.stderr)
+    return 1
+
+
+def _run_prune(
+    plan_only: bool = False,
+    plan_path: str | None = None,
+    budget_bytes: int | None = None,
+    min_keep: int = 1,
+    min_keep_per_repo: dict[str, int] | None = None,
+    gc: str = "auto",
+    delete_untagged: bool = False,
+) -> int:
     """Run prune logic. Prints to stdout/stderr. Returns exit code (0 = success)."""
     registry_url = os.environ.get("REGISTRY_URL") or ""
     if not registry_url:
         print("REGISTRY_URL required", file=sys.stderr)
         return 1
-    repos = crane_catalog(registry_url)
-    if not repos:
-        print("No repos in registry, nothing to prune.")
-        return 0
-    deleted_count = _process_repos(registry_url, [(repo, KEEP) for repo in repos])
-
+    if gc not in GC_MODES:
+        print(f"gc must be one of {', '.join(GC_MODES)}, got {gc!r}", file=sys.stderr)
+        return 1
+    client = RegistryClient(registry_url, max_in_flight=MAX_IN_FLIGHT, max_rps=MAX_RPS)
+    source = "api"
+    if STORAGE_ROOT:
+        # Drop-in for every read below (same methods); delete() is forwarded to the API client.
+        started = time.monotonic()
+        try:
+            client = RegistryStorage(Path(STORAGE_ROOT), client)
+            source = STORAGE_ROOT
+            print(f"Scanned registry storage {STORAGE_ROOT} in {time.monotonic() - started:.1f}s")
+        except RegistryError as e:
+            print(f"Registry storage scan failed, using the API: {e}", file=sys.stderr)
+    cache = ImageCache(IMAGE_CACHE_PATH)
+    # Deployed tag per app (protected from pruning), from the deploy state index.
+    deploy_state = DeployState()
+    print(f"Deploy state: {deploy_state.sync()} app(s) changed since last sync")
+    catalog: set[str] = set()
+
+    def repos() -> Iterable[tuple[str, int]]:
+        for repo in client.iter_catalog(PAGE_SIZE):
+            catalog.add(repo)
+            if budget_bytes is None:
+                yield repo, KEEP
+            else:
+                # Budget mode: plan down to the minimum; the budget picks what actually goes.
+                yield repo, (min_keep_per_repo or {}).get(repo, min_keep)
+
+    retention = f"budget {_format_bytes(budget_bytes)}" if budget_bytes is not None else f"keep {KEEP}"
+    print(
+        f"Pruning registry: repo_workers={REPO_WORKERS}, max_in_flight={MAX_IN_FLIGHT}, "
+        f"max_rps={MAX_RPS or 'unlimited'}, page_size={PAGE_SIZE}, source={source}, "
+        f"mode={'plan' if plan_only else 'apply plan' if plan_path else 'prune'}, "
+        f"retention={retention}"
+    )
+    try:
+        if plan_path and not plan_only:
+            plan = json.loads(Path(plan_path).read_text())
+            print(f"Applying plan {plan_path} from {plan.get('created_at', '?')}")
+            deleted_count, failures = _apply_plan(client, cache, deploy_state, plan)
+            # Upper bound: tags skipped on re-check still count.
+            reclaimable = int(plan.get("bytes_reclaimed") or 0)
+        else:
+            budget = budget_bytes is not None
+            plans, deleted_count, failures = _process_repos(
+                client, cache, deploy_state, repos(), apply=not (plan_only or budget)
+            )
+            if "(catalog)" not in failures:
+                cache.retain_repos(catalog)
+            if not plans and not failures:
+                print("No repos in registry, nothing to prune.")
+                return 0
+            if budget:
+                before, after = _select_for_budget(plans, cache, budget_bytes)
+                print(
+                    f"Storage budget {_format_bytes(budget_bytes)}: in use {_format_bytes(before)} "
+                    f"before, {_format_bytes(after)} after (deduplicated layers of tagged images)"
+                )
+                if after > budget_bytes:
+                    print("Budget not reachable: remaining tags are protected or at their minimum", file=sys.stderr)
+            plan = _build_plan(registry_url, plans, cache)
+            reclaimable = plan["bytes_reclaimed"]
+            if budget and not plan_only:
+                deleted_count, apply_failures = _apply_plan(client, cache, deploy_state, plan, verify=False)
+                failures.update(apply_failures)
+            if plan_only:
+                path = Path(plan_path) if plan_path else PLAN_PATH
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(json.dumps(plan, indent=1))
+                print(f"Plan written to {path}")
+    finally:
+        client.close()
+        deploy_state.close()
+        # Saved on failure too: configs fetched so far are valid for the next run.
+        evicted = cache.save()
+        print(f"Image cache: {cache.hits} hit(s), {cache.misses} miss(es), {evicted} evicted")
+        try:
+            print(f"Version index: {write_indexes(VERSION_INDEX_ROOT, cache)} repo(s) in {VERSION_INDEX_ROOT}")
+        except OSError as e:
+            print(f"Could not write version index in {VERSION_INDEX_ROOT}: {e}", file=sys.stderr)
+
+    if plan_only:
+        print("Plan only: nothing deleted.")
+        return _report_failures(failures)
     if deleted_count > 0:
-        registry_garbage_collect()
-        print("Registry garbage-collect completed")
         print(f"Pruned {deleted_count} tag(s) in total.")
     else:
         print("No tags to delete (all within keep count or protected).")
-    return 0
+    # Orphans of earlier runs that skipped GC count towards the threshold too.
+    pending = _pending_orphans() + reclaimable
+    if gc == "always" or (gc == "auto" and delete_untagged):
+        _measured_gc(pending, delete_untagged)
+    elif gc == "auto" and pending > 0 and pending >= GC_MIN_BYTES:
+        _measured_gc(pending, delete_untagged)
+    else:
+        reason = (
+            "gc=never"
+            if gc == "never"
+            else f"estimated {_format_bytes(pending)} orphaned, threshold {_format_bytes(GC_MIN_BYTES)}"
+        )
+        print(
+            f"MEASURE: step=registry_gc skipped=true estimated_bytes={reclaimable} "
+            f"pending_bytes={pending}"
+        )
+        print(f"Skipping registry garbage-collect ({reason})")
+        _record_gc({"skipped": True, "estimated_bytes": reclaimable, "pending_bytes": pending})
+        if delete_untagged:
+            print("delete_untagged ignored with gc=never: untagged manifests stay until the next GC")
+    return _report_failures(failures)
+
+
+class _LogStream(io.TextIOBase):
+    """stdout/stderr replacement that forwards each complete line to a logger as it is written.
+
+    Repo workers print concurrently, so partial lines are buffered per thread; the lines of
+    one write() are logged together. Only the last lines are kept (`tail`), for the error.
+    Writes made while logging (a handler printing to the swapped stream) go to `fallback`.
+    """
+
+    # Shared by stdout and stderr: a handler may print to either while we log.
+    _logging = threading.local()
+
+    def __init__(
+        self,
+        log: Callable[[str], None],
+        tail: deque[str],
+        lock: threading.RLock,
+        fallback: io.TextIOBase,
+    ):
+        self._log = log
+        self._tail = tail
+        self._lock = lock
+        self._fallback = fallback
+        self._local = threading.local()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if getattr(self._logging, "active", False):
+            return self._fallback.write(text)
+        *lines, self._local.partial = (getattr(self._local, "partial", "") + text).split("\n")
+        self._emit(lines)
+        return len(text)
+
+    def flush(self) -> None:
+        partial = getattr(self._local, "partial", "")
+        self._local.partial = ""
+        self._emit([partial])
+
+    def _emit(self, lines: list[str]) -> None:
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return
+        with self._lock:
+            self._tail.extend(lines)
+            self._logging.active = True
+            try:
+                for line in lines:
+                    self._log(line)
+            finally:
+                self._logging.active = False
 
 
 @flow
-def registry_prune():
+def registry_prune(
+    plan_only: bool = False,
+    plan_path: str | None = None,
+    budget_bytes: int | None = None,
+    min_keep: int = 1,
+    min_keep_per_repo: dict[str, int] | None = None,
+    gc: str = "auto",
+    delete_untagged: bool = False,
+):
     """
-    List all repos (crane catalog), prune each to 6 tags, protect deployed tag per repo,
+    List all repos (registry catalog), prune each to 6 tags, protect deployed tag per repo,
     then run registry garbage-collect.
+
+    plan_only: write the plan (tags to delete, reclaimable bytes per repo) and delete nothing.
+    plan_path: where plan_only writes the plan; without plan_only, apply that saved plan.
+    budget_bytes: retain by total registry size instead of KEEP per repo (oldest go first).
+    min_keep / min_keep_per_repo: newest tags per repo the budget never drops (default 1).
+    gc: "auto" runs garbage-collect only if the estimated orphaned bytes reach
+        REGISTRY_GC_MIN_BYTES; "always" / "never" override.
+    delete_untagged: also delete manifests no tag points at (runs GC unless gc="never").
     """
-    out = StringIO()
-    err = StringIO()
+    logger = get_run_logger()
+    tail: deque[str] = deque(maxlen=LOG_TAIL_LINES)
+    lock = threading.RLock()
     old_stdout, old_stderr = sys.stdout, sys.stderr
+    out = _LogStream(logger.info, tail, lock, old_stdout)
+    err = _LogStream(logger.warning, tail, lock, old_stderr)
     try:
         sys.stdout = out
         sys.stderr = err
-        exit_code = _run_prune()
+        exit_code = _run_prune(
+            plan_only, plan_path, budget_bytes, min_keep, min_keep_per_repo, gc, delete_untagged
+        )
     finally:
+        out.flush()
+        err.flush()
         sys.stdout = old_stdout
         sys.stderr = old_stderr
 
-    logger = get_run_logger()
-    if out.getvalue().strip():
-        for line in out.getvalue().strip().splitlines():
-            logger.info(line)
-    if err.getvalue().strip():
-        for line in err.getvalue().strip().splitlines():
-            logger.warning(line)
-
     if exit_code != 0:
         raise RuntimeError(
-            f"registry prune exited with {exit_code}\nstdout:\n{out.getvalue() or '(none)'}\nstderr:\n{err.getvalue() or '(none)'}"
+            f"registry prune exited with {exit_code}; last {len(tail)} line(s) of output:\n" + "\n".join(tail)
         )
     return exit_code
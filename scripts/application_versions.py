@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
+import argparse
+import heapq
+import json
 import sys
 import os
-import subprocess
+import shlex
 import yaml
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
+
+# Shared registry client lives with the Prefect flows (stdlib only).
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "prefect"))
+from common.image_cache import ImageCache  # noqa: E402
+from common.registry import RegistryClient, RegistryError  # noqa: E402
+from common.version_index import index_path, parse_index  # noqa: E402
+from remote import RemoteError, read_remote_globs, read_remote_outputs, run_remote  # noqa: E402
+
+# Written by the registry prune flow on the server after each run.
+VERSION_INDEX_ROOT = Path("/opt/iac/prefect/version-index")
+# Written by the deploy playbook, one per app (current state).
+DEPLOY_INFO_GLOB = "/opt/iac/deploy/*/deploy-info.yml"
+# Deploy state index on the server (prefect/common/deploy_state.py): all apps as JSON.
+DEPLOY_STATE_COMMAND = "cd /opt/iac/prefect/flows && python3 -m common.deploy_state dump"
+WORKSPACES = ("dev", "prod")
 
 # ANSI color codes
 BOLD = "\033[1m"
@@ -15,12 +35,6 @@ RESET = "\033[0m"
 # Utilities
 # ------------------------------------------------------------
 
-def run(cmd: str) -> str:
-    """Run a shell command and return stdout (trimmed)."""
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    return result.stdout.strip()
-
-
 def die(message: str):
     print(f"❌ {message}")
     sys.exit(1)
@@ -39,44 +53,75 @@ def get_hostname(workspace: str) -> str:
     return f"{workspace}.{base_domain}"
 
 
-def read_remote_file(hostname: str, path: str) -> str:
-    return run(
-        f'ssh -o StrictHostKeyChecking=accept-new '
-        f'-o ConnectTimeout=5 '
-        f'-o BatchMode=yes '
-        f'ubuntu@{hostname} "cat {path} 2>/dev/null"'
-    )
+def deploy_history_paths(app_name: str) -> list[str]:
+    """deploy-history.jsonl, then the legacy YAML file (read only until the next deploy migrates it)."""
+    return [f"/opt/iac/deploy/{app_name}/deploy-history.jsonl", f"/opt/iac/deploy/{app_name}/deploy-history.yml"]
+
+
+def version_index_path(image_repo: str) -> str:
+    return str(index_path(VERSION_INDEX_ROOT, image_repo))
+
+
+def history_tail_command(path: str, workspace: str, lines: int = 5) -> str:
+    """Shell command printing the newest `lines` history lines that mention workspace.
+
+    tac reads the file from the end and grep stops at the last match it needs, so only
+    those lines cross the SSH connection (file order kept for _latest_jsonl_entry).
+    """
+    needle = f'"workspace":{json.dumps(workspace)}'
+    return f"tac {shlex.quote(path)} | grep -m {lines} -F {shlex.quote(needle)} | tac"
 
 
 # ------------------------------------------------------------
 # Deployment state
 # ------------------------------------------------------------
 
-def get_current_deployed_digest(hostname: str, app_name: str, workspace: str) -> str:
-    """
-    Return the digest of the *currently deployed* image for the workspace,
-    based on the last matching entry in deploy-history.yml.
+def _latest_jsonl_entry(content: str, workspace: str) -> dict | None:
+    """Last entry for workspace, scanning lines from the end (stops at the first match).
+
+    content is the file's tail as printed by history_tail_command, or any JSON lines.
     """
-    path = f"/opt/iac/deploy/{app_name}/deploy-history.yml"
-    content = read_remote_file(hostname, path)
-    if not content:
-        return ""
+    for line in reversed(content.splitlines()):
+        # Cheap pre-filter before parsing; entries are compact JSON written by deploy_history.py.
+        if workspace not in line:
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(entry, dict) and (entry.get("deployment") or {}).get("workspace") == workspace:
+            return entry
+    return None
+
 
+def _latest_yaml_entry(content: str, workspace: str) -> dict | None:
     data = yaml.safe_load(content)
     if not isinstance(data, list):
-        return ""
-
+        return None
     # Only entries for this workspace
     entries = [
         e for e in data
         if e.get("deployment", {}).get("workspace") == workspace
     ]
+    return entries[-1] if entries else None
 
-    if not entries:
+
+def get_current_deployed_digest(history_jsonl: str, history_yaml: str, workspace: str) -> str:
+    """
+    Return the digest of the *currently deployed* image for the workspace,
+    based on the last matching entry in deploy-history.jsonl (or the legacy
+    deploy-history.yml when the app has not been deployed since the migration).
+    """
+    latest = None
+    if history_jsonl:
+        latest = _latest_jsonl_entry(history_jsonl, workspace)
+    elif history_yaml:
+        latest = _latest_yaml_entry(history_yaml, workspace)
+
+    if not latest:
         return ""
 
-    latest = entries[-1]
-    digest = latest.get("image", {}).get("digest", "").strip()
+    digest = str((latest.get("image") or {}).get("digest") or "").strip()
 
     if digest and not digest.startswith("sha256:"):
         digest = f"sha256:{digest}"
@@ -84,13 +129,27 @@ def get_current_deployed_digest(hostname: str, app_name: str, workspace: str) ->
     return digest
 
 
+def read_deploy_state(hostname: str) -> dict[str, dict] | None:
+    """{app: row} from the server's deploy state index; None if unavailable (older server)."""
+    result = run_remote(hostname, DEPLOY_STATE_COMMAND)
+    if result.returncode != 0:
+        return None
+    try:
+        rows = json.loads(result.stdout)
+    except json.JSONDecodeError:
+        return None
+    return {row["app"]: row for row in rows if isinstance(row, dict) and row.get("app")}
+
+
 # ------------------------------------------------------------
 # Registry helpers
 # ------------------------------------------------------------
 
-def list_tags(full_repo: str) -> list[str]:
-    output = run(f"crane ls {full_repo} 2>/dev/null || true")
-    return output.splitlines()
+def list_tags(client: RegistryClient, image_repo: str) -> list[str]:
+    try:
+        return client.tags(image_repo)
+    except RegistryError:
+        return []
 
 
 def parse_timestamp(ts: str) -> datetime | None:
@@ -117,34 +176,240 @@ def _sort_key_timestamp(ts: str) -> tuple[bool, float]:
     return False, dt.timestamp()
 
 
-def get_image_metadata(full_repo: str, tag: str) -> tuple[str, str, str]:
-    """Fetch digest and config for one tag. Used sequentially or from a thread."""
-    tag_ref = f"{full_repo}:{tag}"
+def open_image_cache(client: RegistryClient) -> ImageCache:
+    """Local digest-keyed config cache (per registry host) under ~/.cache/iac."""
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return ImageCache(cache_home / "iac" / f"registry-{client.host}.json")
 
-    digest = run(f"crane digest {tag_ref} 2>/dev/null || echo ''").strip()
-    if digest and not digest.startswith("sha256:"):
-        digest = f"sha256:{digest}"
-
-    config_raw = run(f"crane config {tag_ref} 2>/dev/null || echo ''")
 
-    created = ""
-    description = ""
+def get_image_metadata(
+    client: RegistryClient, cache: ImageCache, image_repo: str, tag: str
+) -> tuple[str, str, str]:
+    """Fetch digest (HEAD) and config (cached per digest) for one tag. Used from a thread."""
+    try:
+        digest = client.digest(image_repo, tag)
+    except RegistryError:
+        digest = ""
 
-    if config_raw:
+    config = {}
+    if digest:
         try:
-            config = json.loads(config_raw)
-            labels = config.get("config", {}).get("Labels", {})
-            created = labels.get("org.opencontainers.image.created", "").split("+")[0]
-            description = labels.get("org.opencontainers.image.description", "")
-        except json.JSONDecodeError:
+            config = cache.config(client, image_repo, digest)
+        except RegistryError:
             pass
 
-    if len(description) > 38:
-        description = description[:38]
-
+    labels = config.get("config", {}).get("Labels", {}) or {}
+    created = labels.get("org.opencontainers.image.created", "")
+    description = labels.get("org.opencontainers.image.description", "")
     return digest, created, description
 
 
+def _fetch_row(client: RegistryClient, cache: ImageCache, image_repo: str, tag: str) -> dict:
+    try:
+        digest, created, description = get_image_metadata(client, cache, image_repo, tag)
+    except Exception:
+        digest, created, description = "", "", ""
+    return {"tag": tag, "digest": digest, "created": created, "description": description}
+
+
+def _fetch_in_order(executor: ThreadPoolExecutor, fetch, tags: list[str], window: int) -> Iterator[dict]:
+    """Yield fetch(tag) in tags order, keeping up to `window` requests ahead."""
+    queued = iter(tags)
+    pending: deque = deque()
+    try:
+        for tag in queued:
+            pending.append(executor.submit(fetch, tag))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Consumer stopped early (--limit): drop what has not started.
+        for future in pending:
+            future.cancel()
+
+
+def iter_live_images(
+    client: RegistryClient, cache: ImageCache, image_repo: str, tags: list[str], limit: int | None = None
+) -> Iterator[dict]:
+    """Query the registry and yield rows newest first as they are known.
+
+    Tags the local cache has seen are fetched lazily in cached-created order; tags new
+    since the last run could be the newest, so those are fetched before the first row.
+    With limit, known tags past the first `limit` rows are never fetched.
+    """
+    known = cache.tag_images(image_repo)
+    new = [t for t in tags if t not in known]
+    old = sorted(
+        (t for t in tags if t in known),
+        key=lambda t: _sort_key_timestamp(known[t]["created"]),
+        reverse=True,
+    )
+    # Keep the cached mapping for tags not fetched this time, so their configs stay cached.
+    mapping = {t: known[t]["digest"] for t in old}
+
+    def fetch(tag: str) -> dict:
+        return _fetch_row(client, cache, image_repo, tag)
+
+    def newest_first(row: dict) -> tuple[bool, float]:
+        return _sort_key_timestamp(row["created"])
+
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        fresh = sorted(executor.map(fetch, new), key=newest_first, reverse=True)
+        ordered = _fetch_in_order(executor, fetch, old, 40)
+        rows = heapq.merge(fresh, ordered, key=newest_first, reverse=True)
+        for count, row in enumerate(rows, 1):
+            if row["digest"]:
+                mapping[row["tag"]] = row["digest"]
+            yield row
+            if limit and count >= limit:
+                break
+        ordered.close()
+
+    cache.record_tags(image_repo, mapping)
+    cache.save()
+
+
+# ------------------------------------------------------------
+# Fleet (all apps, all workspaces)
+# ------------------------------------------------------------
+
+def registry_repo(image_ref: str) -> str:
+    """Repo path in the registry for an image reference (drops a registry host prefix)."""
+    first, _, rest = image_ref.partition("/")
+    return rest if rest and ("." in first or ":" in first) else image_ref
+
+
+def read_host_state(hostname: str) -> tuple[dict[str, dict], dict[str, dict]]:
+    """({repo: deployed image}, {repo: version index}) for one host.
+
+    Deployed images come from the deploy state index, or every deploy-info.yml on servers
+    without it; version indexes are read in one round trip. Raises RemoteError if the host
+    cannot be reached.
+    """
+    state = read_deploy_state(hostname)
+    patterns = [f"{VERSION_INDEX_ROOT}/*.json", f"{VERSION_INDEX_ROOT}/*/*.json"]
+    files = read_remote_globs(hostname, patterns if state is not None else [DEPLOY_INFO_GLOB, *patterns])
+    deployed: dict[str, dict] = {}
+    indexes: dict[str, dict] = {}
+    for app, row in (state or {}).items():
+        repo = registry_repo(row.get("image_repo") or "")
+        if repo:
+            deployed[repo] = {"app": app, "tag": row.get("image_tag") or "", "digest": row.get("image_digest") or ""}
+    for path, content in files.items():
+        if path.endswith("/deploy-info.yml"):
+            try:
+                data = yaml.safe_load(content) or {}
+            except yaml.YAMLError:
+                continue
+            image = data.get("image") or {}
+            repo = registry_repo(str(image.get("repo") or ""))
+            digest = str(image.get("digest") or "").strip()
+            if digest and not digest.startswith("sha256:"):
+                digest = f"sha256:{digest}"
+            if repo:
+                deployed[repo] = {
+                    "app": data.get("app") or repo.split("/")[-1],
+                    "tag": str(image.get("tag") or ""),
+                    "digest": digest,
+                }
+        else:
+            index = parse_index(content)
+            if index is not None and index.get("repo"):
+                indexes[index["repo"]] = index
+    return deployed, indexes
+
+
+def behind_newest(images: list[dict], digest: str) -> int | None:
+    """Number of tags newer than the deployed digest (images newest first); None if not listed."""
+    for position, img in enumerate(images):
+        if img["digest"] == digest:
+            return position
+    return None
+
+
+def fleet_rows(registry: str, refresh: bool) -> list[dict]:
+    """Collect catalog + both hosts concurrently, then one row per app."""
+    hosts = {ws: get_hostname(ws) for ws in WORKSPACES}
+    client = RegistryClient(registry, max_in_flight=20)
+    try:
+        with ThreadPoolExecutor(max_workers=len(hosts) + 1) as executor:
+            catalog_future = executor.submit(client.catalog)
+            state_futures = {ws: executor.submit(read_host_state, host) for ws, host in hosts.items()}
+            try:
+                catalog = catalog_future.result()
+            except RegistryError as e:
+                print(f"⚠️  Registry catalog unavailable: {e}", file=sys.stderr)
+                catalog = []
+            states: dict[str, tuple[dict, dict] | None] = {}
+            for ws, future in state_futures.items():
+                try:
+                    states[ws] = future.result()
+                except RemoteError as e:
+                    print(f"⚠️  {ws} unreachable: {e}", file=sys.stderr)
+                    states[ws] = None
+        reachable = [state for state in states.values() if state is not None]
+
+        repos = sorted(set(catalog) | {repo for deployed, _ in reachable for repo in deployed})
+        # Newest index across hosts; repos without one (or --refresh) are queried live.
+        newest_index: dict[str, dict] = {}
+        if not refresh:
+            for _, indexes in reachable:
+                for repo, index in indexes.items():
+                    seen = newest_index.get(repo)
+                    if seen is None or index.get("generated_at", "") > seen.get("generated_at", ""):
+                        newest_index[repo] = index
+        images = {repo: index["tags"] for repo, index in newest_index.items()}
+        live = [repo for repo in repos if repo not in images]
+        if live:
+            cache = open_image_cache(client)
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                fetched = executor.map(
+                    lambda repo: list(iter_live_images(client, cache, repo, list_tags(client, repo))), live
+                )
+                images.update(zip(live, fetched))
+    finally:
+        client.close()
+
+    rows = []
+    for repo in repos:
+        tags = images.get(repo) or []
+        row = {"repo": repo, "app": repo.split("/")[-1], "newest": tags[0]["tag"] if tags else "", "workspaces": {}}
+        for ws, state in states.items():
+            if state is None:
+                row["workspaces"][ws] = "unreachable"
+                continue
+            current = state[0].get(repo)
+            if current is None:
+                row["workspaces"][ws] = None
+                continue
+            row["app"] = current["app"]
+            row["workspaces"][ws] = {**current, "behind": behind_newest(tags, current["digest"])}
+        digests = {d["digest"] for d in row["workspaces"].values() if isinstance(d, dict)}
+        row["drift"] = len(digests) > 1
+        rows.append(row)
+    return rows
+
+
+def print_fleet(rows: list[dict]):
+    def cell(deployed: dict | str | None) -> str:
+        if deployed is None:
+            return "-"
+        if isinstance(deployed, str):
+            return deployed
+        behind = deployed["behind"]
+        suffix = "" if behind == 0 else " (?)" if behind is None else f" (-{behind})"
+        return f"{deployed['tag']}{suffix}"
+
+    print(f"  {'APP':20} {'NEWEST':12} " + " ".join(f"{ws.upper():16}" for ws in WORKSPACES) + " DRIFT")
+    for row in rows:
+        cells = " ".join(f"{cell(row['workspaces'].get(ws)):16}" for ws in WORKSPACES)
+        line = f"  {row['app']:20} {row['newest'] or '-':12} {cells} {'yes' if row['drift'] else ''}"
+        print(f"{BOLD}{line}{RESET}" if row["drift"] else line)
+    print("")
+    print("  (-N) = N newer tags in the registry; (?) = deployed digest no longer tagged")
+
+
 # ------------------------------------------------------------
 # Output
 # ------------------------------------------------------------
@@ -154,86 +419,132 @@ def print_header():
     print(f"  {'':2} {'-------':20} {'---':16} {'-----------':40}")
 
 
-def print_overview(full_repo: str, tags: list[str], deployed_digest: str):
-    # Collect all image metadata in parallel (crane digest/config per tag are I/O-bound)
-    max_workers = min(20, max(4, len(tags)))
-    images = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_tag = {
-            executor.submit(get_image_metadata, full_repo, tag): tag
-            for tag in tags
-        }
-        for future in as_completed(future_to_tag):
-            tag = future_to_tag[future]
-            try:
-                digest, created, description = future.result()
-                images.append({
-                    "tag": tag,
-                    "digest": digest,
-                    "created": created,
-                    "description": description,
-                    "is_deployed": digest and digest == deployed_digest,
-                })
-            except Exception:
-                images.append({
-                    "tag": tag,
-                    "digest": "",
-                    "created": "",
-                    "description": "",
-                    "is_deployed": False,
-                })
-    
-    # Sort by timestamp (newest first), images without timestamps go to end
-    images.sort(key=lambda x: _sort_key_timestamp(x["created"]), reverse=True)
-    
+def print_overview(images: Iterable[dict], deployed_digest: str):
+    """Print rows as images arrive (callers pass them newest first)."""
     # print_header()
     
     for img in images:
         tag = img["tag"]
-        created = img["created"]
-        description = img["description"]
-        is_deployed = img["is_deployed"]
+        created = img["created"].split("+")[0]
+        description = img["description"][:38]
+        is_deployed = img["digest"] and img["digest"] == deployed_digest
         row = f"  {created:20} {description:40} {tag:16}"
         if is_deployed:
-            print(f"{BOLD} -> {row}{RESET}")
+            print(f"{BOLD} -> {row}{RESET}", flush=True)
         else:
-            print(f"    {row}")
+            print(f"    {row}", flush=True)
     
     print("")
 
 
+def print_json(image_repo: str, workspace: str, images: Iterable[dict], deployed_digest: str, source: dict):
+    """One JSON document on stdout: deployed digest, source of the data, rows newest first."""
+    rows = [{**img, "deployed": bool(img["digest"]) and img["digest"] == deployed_digest} for img in images]
+    print(json.dumps({
+        "image": image_repo,
+        "workspace": workspace,
+        "deployed_digest": deployed_digest,
+        **source,
+        "tags": rows,
+    }, indent=2))
+
+
 # ------------------------------------------------------------
 # Main
 # ------------------------------------------------------------
 
-def main():
-    args = sys.argv[1:]
-
-    if len(args) != 4:
-        die(
-            "Usage: task app:versions -- <environment>\n"
-            "Example: task app:versions -- dev"
-        )
-
-    workspace, registry, image_repo, deploy_slug = args
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="task app:versions --",
+        usage=(
+            "task app:versions -- <environment> <app> [--refresh] [--limit N] [--json]\n"
+            "       task app:fleet [-- --refresh] [--json]"
+        ),
+    )
+    parser.add_argument("positional", nargs="*", help="<workspace> <registry> <image_repo> <deploy_slug>, or <registry> with --fleet")
+    parser.add_argument("--fleet", action="store_true", help="all apps in dev and prod")
+    parser.add_argument("--refresh", action="store_true", help="query the registry instead of the server's version index")
+    parser.add_argument("--limit", type=int, default=None, metavar="N", help="newest N tags only")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of the table")
+    args = parser.parse_args()
+    if len(args.positional) != (1 if args.fleet else 4):
+        parser.print_usage()
+        sys.exit(1)
+    if args.limit is not None and args.limit < 1:
+        die("--limit must be at least 1")
+    if args.fleet and args.limit is not None:
+        die("--limit applies to app:versions, not app:fleet")
+    return args
+
+
+def versions(args: argparse.Namespace):
+    workspace, registry, image_repo, app_name = args.positional
     hostname = get_hostname(workspace)
 
-    full_repo = f"{registry}/{image_repo}"
-    app_name = deploy_slug
+    if not args.json:
+        print(f"IMAGE: {image_repo}\n")
+
+    # Two SSH round trips over the shared connection: the deploy state index (deployed
+    # digest), then the version index together with the deploy history (its newest lines
+    # for this workspace only) on servers without the state index.
+    state = read_deploy_state(hostname)
+    commands = {}
+    if state is None:
+        history_jsonl, history_yaml = deploy_history_paths(app_name)
+        commands["history_jsonl"] = history_tail_command(history_jsonl, workspace)
+        commands["history_yaml"] = f"cat {shlex.quote(history_yaml)}"
+    if not args.refresh:
+        commands["index"] = f"cat {shlex.quote(version_index_path(image_repo))}"
+    remote = read_remote_outputs(hostname, commands)
+
+    if state is not None:
+        deployed_digest = (state.get(app_name) or {}).get("image_digest") or ""
+    else:
+        deployed_digest = get_current_deployed_digest(remote["history_jsonl"], remote["history_yaml"], workspace)
+
+    index = None if args.refresh else parse_index(remote["index"])
+    client = None
+    if index is not None:
+        images = index["tags"][:args.limit] if args.limit else index["tags"]
+        source = {"source": "index", "generated_at": index.get("generated_at", "")}
+        empty = not images
+    else:
+        client = RegistryClient(registry, max_in_flight=20)
+        tags = list_tags(client, image_repo)
+        images = iter_live_images(client, open_image_cache(client), image_repo, tags, args.limit) if tags else []
+        source = {"source": "registry"}
+        empty = not tags
 
-    print(f"IMAGE: {image_repo}\n")
+    try:
+        if args.json:
+            print_json(image_repo, workspace, images, deployed_digest, source)
+        elif empty:
+            print("  ℹ️  No tags found")
+        else:
+            print_overview(images, deployed_digest)
+            if index is not None:
+                print(f"  (index from {index.get('generated_at', '?')}; --refresh for live registry data)")
+    finally:
+        if client is not None:
+            client.close()
 
-    deployed_digest = get_current_deployed_digest(
-        hostname, app_name, workspace
-    )
 
-    tags = list_tags(full_repo)
-    if not tags:
-        print("  ℹ️  No tags found")
-        return
+def fleet(args: argparse.Namespace):
+    rows = fleet_rows(args.positional[0], args.refresh)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    elif not rows:
+        print("  ℹ️  No apps found")
+    else:
+        print_fleet(rows)
 
-    print_overview(full_repo, tags, deployed_digest)
 
+def main():
+    args = parse_args()
+    if args.fleet:
+        fleet(args)
+    else:
+        versions(args)
 
 if __name__ == "__main__":
     main()
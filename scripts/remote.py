@@ -0,0 +1,113 @@
+"""
+SSH access to the servers for the CLI scripts: one multiplexed connection per host.
+
+Every call goes through OpenSSH connection sharing (ControlMaster=auto, a ~/.ssh/cm-cli-*
+socket, kept open for CONTROL_PERSIST after the last use). Only the first call to a host
+pays for the TCP + key exchange; later calls in this run, or in the next script run within
+that window, reuse the master.
+
+read_remote_outputs() runs N commands, read_remote_files() / read_remote_globs() fetch N
+files, each in one round trip (base64 per output, so any content survives the framing).
+"""
+
+from __future__ import annotations
+
+import base64
+import shlex
+import subprocess
+
+# Not the cm-%C of the dev/prod aliases: ~/.ssh is shared with the devcontainer, and a
+# forward-less master from here must never be reused by `ssh dev` (no LocalForward then).
+CONTROL_PATH = "~/.ssh/cm-cli-%C"
+CONTROL_PERSIST = "10m"
+
+SSH_OPTIONS = (
+    "-o", "StrictHostKeyChecking=accept-new",
+    "-o", "ConnectTimeout=5",
+    "-o", "BatchMode=yes",
+    "-o", "ControlMaster=auto",
+    "-o", f"ControlPath={CONTROL_PATH}",
+    "-o", f"ControlPersist={CONTROL_PERSIST}",
+)
+
+_FILE_MARK = "@@iac-file@@"
+_MISSING_MARK = "@@iac-missing@@"
+
+
+class RemoteError(RuntimeError):
+    """SSH session to a host failed (unreachable, auth, remote shell error)."""
+
+
+def ssh_command(hostname: str, remote_command: str, user: str = "ubuntu") -> list[str]:
+    """argv for running remote_command (a shell string) on user@hostname."""
+    return ["ssh", *SSH_OPTIONS, f"{user}@{hostname}", remote_command]
+
+
+def run_remote(hostname: str, remote_command: str, user: str = "ubuntu") -> subprocess.CompletedProcess:
+    """Run remote_command on the host; returns the completed process (text, captured)."""
+    return subprocess.run(ssh_command(hostname, remote_command, user), capture_output=True, text=True)
+
+
+def _read_script(path_expr: str) -> str:
+    """Shell loop printing a marker line + base64 body (or a missing marker) per path."""
+    return (
+        f"for p in {path_expr}; do "
+        f'if [ -r "$p" ]; then echo "{_FILE_MARK} $p"; base64 < "$p"; '
+        f'else echo "{_MISSING_MARK} $p"; fi; done'
+    )
+
+
+def _parse_files(stdout: str) -> dict[str, str]:
+    contents: dict[str, str] = {}
+    current: str | None = None
+    chunks: list[str] = []
+
+    def finish() -> None:
+        if current is not None:
+            contents[current] = base64.b64decode("".join(chunks)).decode(errors="replace")
+
+    for line in stdout.splitlines():
+        if line.startswith(f"{_FILE_MARK} ") or line.startswith(f"{_MISSING_MARK} "):
+            finish()
+            mark, _, path = line.partition(" ")
+            current = path if mark == _FILE_MARK else None
+            chunks = []
+        elif current is not None:
+            chunks.append(line.strip())
+    finish()
+    return contents
+
+
+def read_remote_outputs(hostname: str, commands: dict[str, str], user: str = "ubuntu") -> dict[str, str]:
+    """Run several (trusted) shell commands over one SSH session; {key: stdout}.
+
+    Keys are single-line labels. stderr is dropped; a failing command or session maps to "".
+    """
+    if not commands:
+        return {}
+    script = "; ".join(
+        f'echo "{_FILE_MARK} {key}"; {{ {command}; }} 2>/dev/null | base64'
+        for key, command in commands.items()
+    )
+    result = run_remote(hostname, script, user)
+    return {**dict.fromkeys(commands, ""), **_parse_files(result.stdout)}
+
+
+def read_remote_files(hostname: str, paths: list[str], user: str = "ubuntu") -> dict[str, str]:
+    """Read several remote files over one SSH session. Missing/unreadable files map to ""."""
+    return read_remote_outputs(hostname, {p: f"cat {shlex.quote(p)}" for p in paths}, user)
+
+
+def read_remote_globs(hostname: str, patterns: list[str], user: str = "ubuntu") -> dict[str, str]:
+    """Read every remote file matching the (trusted, unquoted) glob patterns in one session.
+
+    Returns {path: content} for readable matches only. Raises RemoteError if the session
+    fails (the read loop itself always exits 0), so "no files" and "host unreachable"
+    stay distinct.
+    """
+    if not patterns:
+        return {}
+    result = run_remote(hostname, _read_script(" ".join(patterns)), user)
+    if result.returncode != 0:
+        raise RemoteError(f"{hostname}: {result.stderr.strip() or f'ssh exited {result.returncode}'}")
+    return _parse_files(result.stdout)